@@ -5,23 +5,55 @@ PDF Fusion Pro - 激活服务器
 """
 
 import os
-import json
-import base64
+import csv
+import io
+import queue
+import re
+import atexit
 import hashlib
+import hmac
+import itertools
 import logging
 import smtplib
+import socket
+import struct
 import threading
 import time
-from datetime import datetime, timedelta
-from functools import wraps
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, wraps
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.utils import formatdate
-from urllib.parse import parse_qs, unquote
+from urllib.parse import parse_qsl
 
-from flask import Flask, request, jsonify
+import orjson
+from flask import Flask, abort, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider, JSONProvider
 from flask_cors import CORS
-from cryptography.fernet import Fernet
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from utils.products import DEFAULT_PRODUCT_PARAMS, PRODUCT_PARAMS, detect_product_type
+from utils.smtp_pool import SMTP_WIRE_POLICY, SMTPConnectionPool
+
+# PostgreSQL 驱动（未安装时降级到文件存储）
+try:
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.extras
+    from psycopg2.pool import ThreadedConnectionPool
+except ImportError:
+    psycopg2 = None
+
+# 系统状态监控（可选）
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 # 配置日志
 logging.basicConfig(
@@ -30,8 +62,27 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(JSONProvider):
+    """基于 orjson 的 JSON 序列化（jsonify / request.json）"""
+    
+    # datetime 由 orjson 直接输出 ISO 8601，Decimal 等其余类型交给 Flask 默认规则
+    option = orjson.OPT_NON_STR_KEYS
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=DefaultJSONProvider.default,
+                            option=self.option).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=DefaultJSONProvider.default, option=self.option)
+        return self._app.response_class(body, mimetype='application/json')
+
 # 初始化Flask应用
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # 配置类
@@ -42,16 +93,29 @@ class Config:
     ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY', '')
     ADMIN_API_KEY = os.getenv('ADMIN_API_KEY', '')
     DATABASE_URL = os.getenv('DATABASE_URL', '')
+    DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))   # 创建连接池时预先建立的连接数
+    DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+    DB_BATCH_SIZE = int(os.getenv('DB_BATCH_SIZE', '64'))  # 单次批量插入的最大记录数
+    DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))  # 建立连接的超时（秒）
+    # 导入时是否建表；默认关闭，部署时通过 `flask --app activation_server init-db` 执行一次
+    RUN_DB_INIT = os.getenv('RUN_DB_INIT', 'false').lower() == 'true'
     
     # 邮件配置
     SMTP_HOST = os.getenv('SMTP_HOST', '')
     SMTP_PORT = os.getenv('SMTP_PORT', '587')
     SMTP_USER = os.getenv('SMTP_USER', '')
     SMTP_PASSWORD = os.getenv('SMTP_PASSWORD', '')
+    SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', '4'))
     
     # Gumroad配置
     GUMROAD_WEBHOOK_SECRET = os.getenv('GUMROAD_WEBHOOK_SECRET', '')
     
+    # 后台任务线程数（保存记录 + 发送邮件）
+    BACKGROUND_WORKERS = int(os.getenv('BACKGROUND_WORKERS', '4'))
+    
+    # 请求体大小上限（字节），超出直接返回 413
+    MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', str(64 * 1024)))
+    
     @classmethod
     def validate(cls):
         """验证必要配置"""
@@ -63,7 +127,7 @@ class Config:
                 missing.append(var)
         
         if missing:
-            logger.error(f"❌ 缺少必要配置: {', '.join(missing)}")
+            logger.error("❌ 缺少必要配置: %s", ', '.join(missing))
             return False
         
         if not cls.DATABASE_URL:
@@ -74,6 +138,47 @@ class Config:
 
 # 初始化配置
 config = Config()
+app.config['MAX_CONTENT_LENGTH'] = config.MAX_CONTENT_LENGTH
+
+AES_GCM_NONCE_BYTES = 12
+AES_GCM_TAG_BYTES = 16
+
+class ActivationCipher:
+    """AES-GCM 加密器：密钥派生和 AESGCM 对象只在启动时构造一次"""
+    
+    def __init__(self, encryption_key):
+        # 任意长度的密钥字符串都派生为 256 位 AES 密钥
+        self._aesgcm = AESGCM(hashlib.sha256(encryption_key.encode()).digest())
+    
+    def encrypt(self, data):
+        """返回 nonce + 密文（含认证标签）"""
+        nonce = os.urandom(AES_GCM_NONCE_BYTES)
+        return nonce + self._aesgcm.encrypt(nonce, data, None)
+    
+    def decrypt(self, token):
+        """解密 nonce + 密文；认证失败时抛出 InvalidTag"""
+        nonce, ciphertext = token[:AES_GCM_NONCE_BYTES], token[AES_GCM_NONCE_BYTES:]
+        return self._aesgcm.decrypt(nonce, ciphertext, None)
+
+# 简单激活码中的产品类型代码
+TYPE_CODES = {
+    'personal': 'P',
+    'professional': 'R',
+    'business': 'B',
+    'enterprise': 'E'
+}
+
+# 邮件中显示的产品类型名称
+PRODUCT_TYPE_LABELS = {product_type: product_type.capitalize() for product_type in PRODUCT_PARAMS}
+
+# 邮件模板（启动时编译一次，发送时只做渲染）
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+template_env = Environment(
+    loader=FileSystemLoader(TEMPLATE_DIR),
+    autoescape=select_autoescape(['html'])
+)
+EMAIL_HTML_TEMPLATE = template_env.get_template('activation_email_en.html')
+EMAIL_TEXT_TEMPLATE = template_env.get_template('activation_email_en.txt')
 
 # 全局变量
 app_start_time = time.time()
@@ -93,23 +198,10 @@ def init_professional_components():
             if isinstance(encryption_key, bytes):
                 encryption_key = encryption_key.decode('utf-8')
             
-            # 如果密钥不是有效的 base64，尝试修复
-            if len(encryption_key) != 44 or '=' not in encryption_key[-1:]:
-                logger.warning("⚠️  加密密钥格式可能不正确，尝试修复...")
-                # 尝试 base64 编码
-                try:
-                    # 如果已经是字符串，先编码再解码
-                    if isinstance(encryption_key, str):
-                        encryption_key = base64.urlsafe_b64encode(encryption_key.encode()).decode()
-                except:
-                    logger.error("❌ 无法修复加密密钥，将使用简单激活码")
-                    cipher = None
-                else:
-                    cipher = Fernet(encryption_key)
-            else:
-                cipher = Fernet(encryption_key)
+            # 密钥经 SHA-256 派生，不再要求 Fernet 的 44 位 Base64 格式
+            cipher = ActivationCipher(encryption_key)
             
-            logger.info("✅ 加密组件初始化完成")
+            logger.info("✅ 加密组件初始化完成 (AES-GCM)")
         
         # 初始化邮件发送器配置
         smtp_configured = all([
@@ -119,19 +211,31 @@ def init_professional_components():
         ])
         
         if smtp_configured:
-            logger.info(f"✅ 邮件服务已配置: {config.SMTP_USER}")
+            logger.info("✅ 邮件服务已配置: %s", config.SMTP_USER)
         else:
             logger.warning("⚠️  邮件服务未完全配置，将无法发送激活邮件")
         
         return cipher, smtp_configured
         
     except Exception as e:
-        logger.error(f"❌ 专业组件初始化失败: {e}")
+        logger.error("❌ 专业组件初始化失败: %s", e)
         return None, False
 
 # 初始化专业组件
 cipher, smtp_configured = init_professional_components()
 
+# ==================== SMTP 连接池 ====================
+smtp_pool = None
+if all([config.SMTP_HOST, config.SMTP_USER, config.SMTP_PASSWORD]):
+    smtp_pool = SMTPConnectionPool(
+        config.SMTP_HOST,
+        int(config.SMTP_PORT),
+        config.SMTP_USER,
+        config.SMTP_PASSWORD,
+        size=config.SMTP_POOL_SIZE
+    )
+    atexit.register(smtp_pool.close_all)
+
 def safe_init_database():
     """安全地初始化数据库"""
     if not config.DATABASE_URL:
@@ -153,161 +257,422 @@ def safe_init_database():
             return False
             
     except ImportError as e:
-        logger.warning(f"⚠️  无法导入数据库模块: {e}")
+        logger.warning("⚠️  无法导入数据库模块: %s", e)
         logger.warning("💾 降级到本地文件存储")
         return False
     except Exception as e:
-        logger.error(f"❌ 数据库初始化异常: {e}")
+        logger.error("❌ 数据库初始化异常: %s", e)
         logger.warning("💾 降级到本地文件存储")
         return False
 
-# 初始化数据库
-database_initialized = safe_init_database()
+@app.cli.command('init-db')
+def init_db_command():
+    """创建数据库表和索引（每次部署执行一次，不在 worker 启动时执行）"""
+    # 未配置数据库时无需建表；配置了但初始化失败则以非零状态退出
+    if not safe_init_database() and config.DATABASE_URL:
+        raise SystemExit(1)
+
+# 初始化数据库（仅在显式开启时；gunicorn 每个 worker 导入时都会执行到这里）
+if config.RUN_DB_INIT:
+    safe_init_database()
+
+# ==================== 数据库连接池 ====================
+db_pool = None
+db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """获取 PostgreSQL 连接池（首次使用时创建，每个 worker 进程一个）"""
+    global db_pool
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                if psycopg2 is None:
+                    raise RuntimeError("未安装 psycopg2-binary，无法连接数据库")
+                
+                class PreparedConnection(psycopg2.extensions.connection):
+                    """记录本连接上已 PREPARE 的语句"""
+                    def __init__(self, *args, **kwargs):
+                        super().__init__(*args, **kwargs)
+                        self.prepared = set()
+                
+                db_pool = ThreadedConnectionPool(
+                    min(config.DB_POOL_MIN, config.DB_POOL_MAX), config.DB_POOL_MAX,
+                    config.DATABASE_URL,
+                    connection_factory=PreparedConnection,
+                    # 数据库不可达时尽快失败（健康检查、降级到文件存储），不等待系统 TCP 超时
+                    connect_timeout=config.DB_CONNECT_TIMEOUT
+                )
+                atexit.register(db_pool.closeall)
+                logger.info("🔗 数据库连接池已创建 (min=%s, max=%s)",
+                            config.DB_POOL_MIN, config.DB_POOL_MAX)
+    return db_pool
+
+@contextmanager
+def db_connection():
+    """从连接池借用连接，正常退出时提交，异常时回滚"""
+    pool = get_db_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        # 包括 GeneratorExit（流式响应中途被客户端断开）
+        if not conn.closed:
+            try:
+                conn.rollback()
+                # 回滚后 PREPARE 状态不确定，全部释放后重新准备
+                with conn.cursor() as cursor:
+                    cursor.execute("DEALLOCATE ALL")
+                conn.commit()
+                conn.prepared.clear()
+            except Exception:
+                conn.close()
+        raise
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+
+def prepare_statement(cursor, name, sql):
+    """在当前连接上 PREPARE 语句（每个连接只执行一次）"""
+    prepared = cursor.connection.prepared
+    if name not in prepared:
+        cursor.execute(f"PREPARE {name} AS {sql}")
+        prepared.add(name)
+
+INSERT_ACTIVATION_SQL = '''
+    INSERT INTO activations 
+    (email, activation_code, product_type, days_valid, max_devices, valid_until, metadata)
+    VALUES ($1, $2, $3, $4, $5, $6, $7)
+    ON CONFLICT (activation_code) DO NOTHING
+'''
+
+INSERT_PURCHASE_SQL = '''
+    INSERT INTO purchases (purchase_id, email, product_name, gumroad_data, processed)
+    VALUES ($1, $2, $3, $4, TRUE)
+    ON CONFLICT (purchase_id) 
+    DO UPDATE SET 
+        processed = TRUE,
+        processed_at = CURRENT_TIMESTAMP
+'''
+
+# 购买记录与激活记录在同一条语句中写入（一次往返、一次提交）
+INSERT_PURCHASE_ACTIVATION_SQL = '''
+    WITH purchase AS (
+        INSERT INTO purchases (purchase_id, email, product_name, gumroad_data, processed)
+        VALUES ($1, $2, $3, $4, TRUE)
+        ON CONFLICT (purchase_id) 
+        DO UPDATE SET 
+            processed = TRUE,
+            processed_at = CURRENT_TIMESTAMP
+        RETURNING purchase_id
+    )
+    INSERT INTO activations 
+    (email, activation_code, product_type, days_valid, max_devices, valid_until, metadata)
+    VALUES ($5, $6, $7, $8, $9, $10, $11)
+    ON CONFLICT (activation_code) DO NOTHING
+'''
+
+# 检查接口的查询同样按连接预备
+SELECT_PURCHASE_SQL = '''
+    SELECT * FROM purchases WHERE purchase_id = $1
+'''
+
+# 两个等值条件分别走表达式索引，UNION ALL 避免 OR 退化为全表扫描
+SELECT_ACTIVATION_BY_PURCHASE_SQL = '''
+    SELECT email, activation_code, product_type, generated_at, metadata 
+    FROM activations 
+    WHERE metadata->>'purchase_id' = $1
+    UNION ALL
+    SELECT email, activation_code, product_type, generated_at, metadata 
+    FROM activations 
+    WHERE metadata->>'sale_id' = $1
+    LIMIT 1
+'''
+
+SELECT_ACTIVATION_SQL = '''
+    SELECT * FROM activations WHERE activation_code = $1
+'''
+
+# 旧版激活码只能按记录验证：取出产品类型和到期时间
+SELECT_ACTIVATION_VALIDITY_SQL = '''
+    SELECT product_type, valid_until FROM activations WHERE activation_code = $1
+'''
+
+# 只探测是否存在（?details=0）：一次往返，不读取整行
+PURCHASE_EXISTS_SQL = '''
+    SELECT EXISTS(SELECT 1 FROM purchases WHERE purchase_id = $1),
+           EXISTS(SELECT 1 FROM activations WHERE metadata->>'purchase_id' = $1)
+           OR EXISTS(SELECT 1 FROM activations WHERE metadata->>'sale_id' = $1)
+'''
+
+ACTIVATION_EXISTS_SQL = '''
+    SELECT EXISTS(SELECT 1 FROM activations WHERE activation_code = $1)
+'''
+
+BATCH_INSERT_ACTIVATION_SQL = '''
+    INSERT INTO activations 
+    (email, activation_code, product_type, days_valid, max_devices, valid_until, metadata)
+    VALUES %s
+    ON CONFLICT (activation_code) DO NOTHING
+'''
+BATCH_INSERT_ACTIVATION_TEMPLATE = '(%s, %s, %s, %s, %s, %s, %s)'
 
 # ==================== 工具函数 ====================
 
+# 表单字段数上限（Gumroad 回调约 30 个字段），超出视为异常请求
+FORM_MAX_FIELDS = 200
+
 def parse_form_data(data):
     """解析 form-urlencoded 数据"""
     try:
-        # 解析查询字符串
-        parsed = parse_qs(data, keep_blank_values=True)
-        
-        # 将列表值转换为单个值，并解码 URL 编码
+        # parse_qsl 已完成 URL 解码，单次遍历即可；重复的键合并为列表
         result = {}
-        for key, value in parsed.items():
-            if isinstance(value, list):
-                if len(value) == 1:
-                    result[key] = unquote(value[0])
-                else:
-                    result[key] = [unquote(v) for v in value]
+        for key, value in parse_qsl(data, keep_blank_values=True,
+                                    max_num_fields=FORM_MAX_FIELDS):
+            if key not in result:
+                result[key] = value
+            elif isinstance(result[key], list):
+                result[key].append(value)
             else:
-                result[key] = unquote(value)
+                result[key] = [result[key], value]
         
         return result
     except Exception as e:
-        logger.error(f"解析 form-data 失败: {e}")
+        logger.error("解析 form-data 失败: %s", e)
         return {}
 
+# 管理员密钥预先编码，每次请求只做一次常量时间比较
+ADMIN_API_KEY_BYTES = config.ADMIN_API_KEY.encode()
+
+# 未授权访问日志限流：每个 IP 每秒最多记录一条，其余只计数
+AUTH_WARN_INTERVAL = 1.0
+AUTH_WARN_MAX_TRACKED = 1024
+auth_warn_state = {}
+auth_warn_lock = threading.Lock()
+
+def warn_unauthorized(remote_addr):
+    """记录未授权访问（限流，避免扫描流量拖慢日志输出）"""
+    now = time.monotonic()
+    with auth_warn_lock:
+        last_logged, suppressed = auth_warn_state.get(remote_addr, (0.0, 0))
+        if now - last_logged < AUTH_WARN_INTERVAL:
+            auth_warn_state[remote_addr] = (last_logged, suppressed + 1)
+            return
+        if len(auth_warn_state) >= AUTH_WARN_MAX_TRACKED:
+            auth_warn_state.clear()
+        auth_warn_state[remote_addr] = (now, 0)
+    
+    if suppressed:
+        logger.warning("未授权访问尝试: %s（此前 %s 次未记录）", remote_addr, suppressed)
+    else:
+        logger.warning("未授权访问尝试: %s", remote_addr)
+
+class TTLCache:
+    """线程安全的有界 LRU 缓存，条目写入 ttl 秒后过期"""
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _get_locked(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+    
+    def get(self, key):
+        """返回未过期的值，没有则返回 None"""
+        with self._lock:
+            return self._get_locked(key, time.monotonic())
+    
+    def put_if_absent(self, key, value):
+        """写入 key；已有未过期的值时不覆盖并返回该值，否则返回 None"""
+        now = time.monotonic()
+        with self._lock:
+            existing = self._get_locked(key, now)
+            if existing is not None:
+                return existing
+            self._entries[key] = (now + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return None
+    
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+# Gumroad 对同一笔订单的重试按 sale_id 去重：条目 2 小时后过期
+WEBHOOK_DEDUP_TTL = 2 * 60 * 60
+WEBHOOK_DEDUP_MAX = 4096
+processed_sales = TTLCache(WEBHOOK_DEDUP_MAX, WEBHOOK_DEDUP_TTL)
+
+# 检查接口的查询结果缓存（只缓存已找到的记录，不会把"未找到"缓存下来）
+CHECK_CACHE_TTL = 30
+CHECK_CACHE_MAX = 10000
+activation_check_cache = TTLCache(CHECK_CACHE_MAX, CHECK_CACHE_TTL)
+purchase_check_cache = TTLCache(CHECK_CACHE_MAX, CHECK_CACHE_TTL)
+
 def require_api_key(f):
     """API密钥验证装饰器"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
         api_key = request.headers.get('X-API-Key')
-        if not api_key or api_key != config.ADMIN_API_KEY:
-            logger.warning(f"未授权访问尝试: {request.remote_addr}")
+        if not api_key or not hmac.compare_digest(api_key.encode(), ADMIN_API_KEY_BYTES):
+            warn_unauthorized(request.remote_addr)
             return jsonify({"error": "未授权"}), 401
         return f(*args, **kwargs)
     return decorated_function
 
+# 专业激活码载荷: 版本(1) + 类型代码(1) + 到期日(距 1970-01-01 的天数, 2)
+# 激活码包含完整的 nonce + 密文 + 认证标签，可解密验证；完整性由 AES-GCM 认证标签保证
+CODE_PAYLOAD = struct.Struct('<B1sH')
+CODE_PAYLOAD_VERSION = 1
+CODE_BYTES = AES_GCM_NONCE_BYTES + CODE_PAYLOAD.size + AES_GCM_TAG_BYTES
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# 激活码用大写十六进制 8 位一组、以 - 分隔；字符集不含 -，去掉分隔符后仍可还原
+CODE_GROUP_SIZE = 8
+CODE_GROUP_COUNT = CODE_BYTES * 2 // CODE_GROUP_SIZE
+# 各组在编码结果中的切片位置，预先算好
+CODE_GROUP_SLICES = tuple(
+    slice(i, i + CODE_GROUP_SIZE)
+    for i in range(0, CODE_BYTES * 2, CODE_GROUP_SIZE)
+)
+
+def pack_code_payload(product_type, valid_until):
+    """打包专业激活码的二进制载荷"""
+    return CODE_PAYLOAD.pack(
+        CODE_PAYLOAD_VERSION,
+        TYPE_CODES.get(product_type, 'P').encode(),
+        valid_until.toordinal() - EPOCH_ORDINAL
+    )
+
+def decode_professional_code(activation_code):
+    """解密专业激活码，返回 (产品类型, 到期日)；无法解密或已被篡改时返回 None"""
+    if cipher is None:
+        return None
+    
+    try:
+        # 分隔符可有可无，十六进制不区分大小写
+        payload = cipher.decrypt(bytes.fromhex(activation_code.replace('-', '')))
+        version, type_code, valid_day = CODE_PAYLOAD.unpack(payload)
+    except (InvalidTag, ValueError, struct.error):
+        return None
+    
+    product_type = TYPE_CODE_PRODUCTS.get(type_code.decode('ascii', 'replace'))
+    if version != CODE_PAYLOAD_VERSION or product_type is None:
+        return None
+    return product_type, date.fromordinal(EPOCH_ORDINAL + valid_day)
+
+def format_activation_code(encrypted):
+    """将密文编码为 8 位一组、以 - 分隔的大写十六进制激活码"""
+    encoded = encrypted.hex().upper()
+    return '-'.join(map(encoded.__getitem__, CODE_GROUP_SLICES))
+
 def generate_professional_activation_code(email, product_type="personal", 
-                                         purchase_id="", product_name=""):
-    """生成专业的激活码（使用Fernet加密）"""
+                                         purchase_id="", product_name="", now=None):
+    """生成专业的激活码（使用 AES-GCM 加密）；now 为调用方的请求时间，缺省取当前时间"""
+    # 同一时间基准，保证 generated_at 与 valid_until 一致
+    now = now or datetime.now()
     try:
         if not cipher:
             logger.warning("⚠️  加密组件未初始化，降级到简单激活码")
-            return generate_simple_activation_code(email, product_type)
+            return generate_simple_activation_code(email, product_type, now)
         
         # 根据产品类型设置参数
-        days_valid = 365
-        max_devices = 3
-        
-        if product_type == 'business':
-            days_valid = 365 * 2
-            max_devices = 10
-        elif product_type == 'enterprise':
-            days_valid = 365 * 3
-            max_devices = 99
-        elif product_type == 'professional':
-            days_valid = 365
-            max_devices = 5
+        days_valid, max_devices = PRODUCT_PARAMS.get(product_type, DEFAULT_PRODUCT_PARAMS)
         
         # 准备激活数据
         activation_data = {
             "email": email,
             "product_type": product_type,
             "days_valid": days_valid,
-            "generated_at": datetime.now().isoformat(),
-            "valid_until": (datetime.now() + timedelta(days=days_valid)).isoformat(),
+            "generated_at": now.isoformat(),
+            "valid_until": (now + timedelta(days=days_valid)).isoformat(),
             "max_devices": max_devices,
             "purchase_id": purchase_id,
             "product_name": product_name,
             "version": "2.0"
         }
         
-        # 生成校验码
-        checksum = hashlib.md5(
-            f"{email}:{product_type}:{days_valid}:{purchase_id}".encode()
-        ).hexdigest()[:8]
-        activation_data['checksum'] = checksum
-        
-        # 加密
-        data_str = json.dumps(activation_data, separators=(',', ':'))
-        encrypted = cipher.encrypt(data_str.encode())
-        
-        # Base64编码
-        activation_code = base64.urlsafe_b64encode(encrypted).decode()
+        # 校验码只保存在激活记录中
+        checksum = hashlib.blake2b(
+            f"{email}:{product_type}:{days_valid}:{purchase_id}".encode(),
+            digest_size=4
+        ).digest()
+        activation_data['checksum'] = checksum.hex()
         
-        # 格式化为易读格式 (8位一组)
-        formatted_code = '-'.join([
-            activation_code[i:i+8] 
-            for i in range(0, min(len(activation_code), 48), 8)
-        ])
+        # 加密紧凑载荷（完整的激活数据保存在数据库/文件记录中）
+        encrypted = cipher.encrypt(
+            pack_code_payload(product_type, now + timedelta(days=days_valid))
+        )
         
-        # 确保不超过59字符
-        if len(formatted_code) > 59:
-            formatted_code = formatted_code[:59]
+        # 编码并格式化为易读格式
+        formatted_code = format_activation_code(encrypted)
         
-        logger.info(f"🔐 生成专业激活码: {formatted_code[:20]}...")
+        logger.info("🔐 生成专业激活码: %.20s...", formatted_code)
         return formatted_code, activation_data
         
     except Exception as e:
-        logger.error(f"❌ 生成专业激活码失败: {e}")
-        return generate_simple_activation_code(email, product_type)
+        logger.error("❌ 生成专业激活码失败: %s", e)
+        return generate_simple_activation_code(email, product_type, now)
 
-def generate_simple_activation_code(email, product_type="personal"):
-    """生成简单的激活码"""
-    import secrets
-    
-    # 生成随机部分
-    random_part = secrets.token_hex(6).upper()
+# 预取系统熵，每 ENTROPY_REFILL 字节才调用一次 os.urandom
+ENTROPY_REFILL = 1024
+entropy_buffer = bytearray()
+entropy_lock = threading.Lock()
+# fork 出的 worker 不能沿用父进程已取出的熵，否则会生成相同的激活码
+os.register_at_fork(after_in_child=entropy_buffer.clear)
+
+def random_hex(nbytes):
+    """返回 nbytes 字节密码学安全随机数的大写十六进制表示"""
+    with entropy_lock:
+        if len(entropy_buffer) < nbytes:
+            entropy_buffer.extend(os.urandom(ENTROPY_REFILL))
+        chunk = bytes(entropy_buffer[:nbytes])
+        del entropy_buffer[:nbytes]
+    return chunk.hex().upper()
+
+@lru_cache(maxsize=4096)
+def email_hash_segment(email):
+    """激活码中的邮箱哈希段（同一买家重复购买时直接命中缓存）"""
+    return hashlib.blake2s(email.encode('utf-8'), digest_size=2).hexdigest().upper()
+
+def generate_simple_activation_code(email, product_type="personal", now=None):
+    """生成简单的激活码；now 为调用方的请求时间，缺省取当前时间"""
+    # 生成随机部分（激活码只用 8 位十六进制）
+    random_part = random_hex(4)
     
     # 产品类型代码
-    type_codes = {
-        'personal': 'P', 
-        'professional': 'R',
-        'business': 'B', 
-        'enterprise': 'E'
-    }
-    type_code = type_codes.get(product_type, 'P')
+    type_code = TYPE_CODES.get(product_type, 'P')
     
     # 邮箱哈希
-    email_hash = hashlib.md5(email.encode()).hexdigest()[:4].upper()
+    email_hash = email_hash_segment(email)
     
-    # 时间戳（月日）
-    timestamp = datetime.now().strftime('%m%d')
+    # 时间戳（月日），整个激活码共用同一时间基准
+    now = now or datetime.now()
+    timestamp = now.strftime('%m%d')
     
     # 组合激活码
-    activation_code = f"PDF-{type_code}{timestamp}-{email_hash}-{random_part[:4]}-{random_part[4:8]}"
+    activation_code = "PDF-%s%s-%s-%s-%s" % (
+        type_code, timestamp, email_hash, random_part[:4], random_part[4:]
+    )
     
     # 计算有效期
-    days_valid = 365
-    max_devices = 3
-    
-    if product_type == 'professional':
-        max_devices = 5
-    elif product_type == 'business':
-        days_valid = 365 * 2
-        max_devices = 10
-    elif product_type == 'enterprise':
-        days_valid = 365 * 3
-        max_devices = 99
+    days_valid, max_devices = PRODUCT_PARAMS.get(product_type, DEFAULT_PRODUCT_PARAMS)
     
     # 激活数据
     activation_data = {
         "email": email,
         "product_type": product_type,
-        "generated_at": datetime.now().isoformat(),
-        "valid_until": (datetime.now() + timedelta(days=days_valid)).isoformat(),
+        "generated_at": now.isoformat(),
+        "valid_until": (now + timedelta(days=days_valid)).isoformat(),
         "max_devices": max_devices,
         "days_valid": days_valid,
         "activation_code": activation_code
@@ -315,312 +680,499 @@ def generate_simple_activation_code(email, product_type="personal"):
     
     return activation_code, activation_data
 
+def build_activation_email(email, activation_code, activation_data):
+    """Build the activation email message (text + HTML)"""
+    # Extract information from activation data
+    product_type = activation_data.get('product_type', 'personal')
+    product_type = PRODUCT_TYPE_LABELS.get(product_type) or product_type.capitalize()
+    valid_until = activation_data.get('valid_until', '')[:10]
+    max_devices = activation_data.get('max_devices', 3)
+    product_name = activation_data.get('product_name', 'PDF Fusion Pro')
+    
+    # Create email
+    msg = MIMEMultipart('alternative')
+    
+    # Email headers
+    subject = f"🎉 Your {product_name} {product_type} Edition Activation Code"
+    msg['Subject'] = subject
+    msg['From'] = f"PDF Fusion Pro Team <{config.SMTP_USER}>"
+    msg['To'] = email
+    msg['Date'] = formatdate(localtime=True)
+    
+    # Render email content from precompiled templates
+    template_vars = {
+        "product_name": product_name,
+        "product_type": product_type,
+        "email": email,
+        "valid_until": valid_until,
+        "max_devices": max_devices,
+        "activation_code": activation_code,
+        "year": datetime.now().year
+    }
+    html_content = EMAIL_HTML_TEMPLATE.render(template_vars)
+    text_content = EMAIL_TEXT_TEMPLATE.render(template_vars)
+    
+    # Add text and HTML versions
+    msg.attach(MIMEText(text_content, 'plain'))
+    msg.attach(MIMEText(html_content, 'html'))
+    return msg
+
 def send_activation_email(email, activation_code, activation_data):
     """Send activation email"""
     
     # Check email configuration
     if not all([config.SMTP_HOST, config.SMTP_USER, config.SMTP_PASSWORD]):
         logger.error("❌ Email service not configured, cannot send activation email")
-        logger.info(f"📧 [Simulated] Activation email to: {email}")
-        logger.info(f"   🔑 Activation code: {activation_code}")
-        logger.info(f"   📅 Valid until: {activation_data.get('valid_until', 'N/A')}")
+        logger.info("📧 [Simulated] Activation email to: %s", email)
+        logger.info("   🔑 Activation code: %s", activation_code)
+        logger.info("   📅 Valid until: %s", activation_data.get('valid_until', 'N/A'))
         return False
     
     try:
-        # Extract information from activation data
-        product_type = activation_data.get('product_type', 'personal').capitalize()
-        valid_until = activation_data.get('valid_until', '')[:10]
-        max_devices = activation_data.get('max_devices', 3)
-        product_name = activation_data.get('product_name', 'PDF Fusion Pro')
-        
-        # Create email
-        msg = MIMEMultipart('alternative')
-        
-        # Email headers
-        subject = f"🎉 Your {product_name} {product_type} Edition Activation Code"
-        msg['Subject'] = subject
-        msg['From'] = f"PDF Fusion Pro Team <{config.SMTP_USER}>"
-        msg['To'] = email
-        msg['Date'] = formatdate(localtime=True)
-        
-        # HTML email content
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>{product_name} Activation Code</title>
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px; }}
-                .header {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px; color: white; text-align: center; border-radius: 10px 10px 0 0; }}
-                .content {{ background: white; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-                .code {{ background: #f8f9fa; border: 2px dashed #667eea; padding: 20px; text-align: center; font-family: monospace; font-size: 18px; letter-spacing: 2px; margin: 20px 0; border-radius: 5px; word-break: break-all; }}
-                .info {{ background: #e7f3ff; border-left: 4px solid #1890ff; padding: 15px; margin: 20px 0; }}
-                .warning {{ background: #fff3cd; border: 1px solid #ffeaa7; padding: 15px; border-radius: 5px; margin: 20px 0; }}
-                .footer {{ text-align: center; margin-top: 30px; padding-top: 20px; border-top: 1px solid #eee; color: #666; font-size: 12px; }}
-                table {{ width: 100%; border-collapse: collapse; }}
-                td {{ padding: 8px 0; border-bottom: 1px solid #eee; }}
-                td:first-child {{ font-weight: bold; width: 100px; color: #555; }}
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <h1 style="margin: 0; font-size: 28px;">🎉 Thank you for purchasing {product_name}!</h1>
-                <p style="margin: 10px 0 0 0; opacity: 0.9;">Your {product_type} Edition Activation Information</p>
-            </div>
-            
-            <div class="content">
-                <h2 style="color: #2c3e50; margin-top: 0;">📋 Activation Information</h2>
-                
-                <table>
-                    <tr>
-                        <td>Email Address</td>
-                        <td>{email}</td>
-                    </tr>
-                    <tr>
-                        <td>Product Edition</td>
-                        <td>{product_type} Edition</td>
-                    </tr>
-                    <tr>
-                        <td>Valid Until</td>
-                        <td>{valid_until}</td>
-                    </tr>
-                    <tr>
-                        <td>Supported Devices</td>
-                        <td>{max_devices} devices</td>
-                    </tr>
-                </table>
-                
-                <h3 style="color: #2c3e50; margin-top: 30px;">🔑 Your Activation Code</h3>
-                <div class="code">
-                    {activation_code}
-                </div>
-                <p style="text-align: center; color: #666; font-size: 14px;">
-                    Please copy this activation code and paste it in the software activation window
-                </p>
-                
-                <div class="info">
-                    <h4 style="margin-top: 0; color: #1890ff;">🚀 Activation Steps</h4>
-                    <ol>
-                        <li>Download and install {product_name}</li>
-                        <li>Run the software, click the "Activate" button</li>
-                        <li>Paste the activation code above</li>
-                        <li>Click "Activate" to complete registration</li>
-                    </ol>
-                </div>
-                
-                <div class="warning">
-                    <h4 style="margin-top: 0; color: #856404;">⚠️ Important Reminders</h4>
-                    <ul style="margin: 10px 0; padding-left: 20px;">
-                        <li>Each activation code can be used on up to <strong>{max_devices} devices</strong> simultaneously</li>
-                        <li>Please keep this activation code safe, it cannot be recovered if lost</li>
-                        <li>If you need to change devices, please deactivate from the original device first</li>
-                        <li>Technical support email: getpdffusion7300@gmail.com</li>
-                    </ul>
-                </div>
-            </div>
-            
-            <div class="footer">
-                <p>© {datetime.now().year} {product_name}. All rights reserved.</p>
-                <p>This email is automatically sent, please do not reply directly.</p>
-            </div>
-        </body>
-        </html>
-        """
-        
-        # Plain text content (fallback)
-        text_content = f"""
-Thank you for purchasing {product_name}!
-
-Your activation information:
-Email Address: {email}
-Product Edition: {product_type} Edition
-Valid Until: {valid_until}
-Supported Devices: {max_devices} devices
-
-Your activation code: {activation_code}
-
-Activation Steps:
-1. Download and install {product_name}
-2. Run the software, click the "Activate" button
-3. Paste the activation code above
-4. Click "Activate" to complete registration
-
-Important Reminders:
-• Each activation code can be used on up to {max_devices} devices simultaneously
-• Please keep this activation code safe, it cannot be recovered if lost
-• If you need to change devices, please deactivate from the original device first
-• Technical support email: support@example.com
-
-© {datetime.now().year} {product_name}. All rights reserved.
-This email is automatically sent, please do not reply directly.
-        """
-        
-        # Add text and HTML versions
-        msg.attach(MIMEText(text_content, 'plain'))
-        msg.attach(MIMEText(html_content, 'html'))
-        
-        # Connect to SMTP server and send
-        logger.info(f"📤 Sending email to: {email}")
-        
-        with smtplib.SMTP(config.SMTP_HOST, int(config.SMTP_PORT)) as server:
-            server.starttls()  # Enable secure connection
-            server.login(config.SMTP_USER, config.SMTP_PASSWORD)
-            server.send_message(msg)
-        
-        logger.info(f"✅ Activation email successfully sent to: {email}")
+        # Connect first (pooled connections are already logged in and
+        # NOOP-checked), so nothing is rendered if the SMTP server is unreachable
+        raw_message = None
+        for attempt in range(2):
+            try:
+                with smtp_pool.acquire() as server:
+                    if raw_message is None:
+                        # Flatten once; a retry resends the same bytes
+                        msg = build_activation_email(email, activation_code, activation_data)
+                        raw_message = msg.as_bytes(policy=SMTP_WIRE_POLICY)
+                    
+                    logger.info("📤 Sending email to: %s", email)
+                    server.sendmail(config.SMTP_USER, [email], raw_message)
+                break
+            except smtplib.SMTPServerDisconnected:
+                # The server may drop a reused session between NOOP and send;
+                # retry once on a fresh connection
+                if attempt:
+                    raise
+                logger.warning("⚠️  SMTP session dropped, reconnecting")
+        
+        logger.info("✅ Activation email successfully sent to: %s", email)
         return True
         
     except Exception as e:
-        logger.error(f"❌ Failed to send email: {e}")
+        logger.error("❌ Failed to send email: %s", e)
         # Log simulated sending information for debugging
-        logger.info(f"📧 [Failed Simulation] Activation email to: {email}")
-        logger.info(f"   🔑 Activation code: {activation_code}")
-        logger.info(f"   📅 Valid until: {activation_data.get('valid_until', 'N/A')}")
+        logger.info("📧 [Failed Simulation] Activation email to: %s", email)
+        logger.info("   🔑 Activation code: %s", activation_code)
+        logger.info("   📅 Valid until: %s", activation_data.get('valid_until', 'N/A'))
+        return False
+
+CREATE_PURCHASES_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS purchases (
+        id SERIAL PRIMARY KEY,
+        purchase_id VARCHAR(255) UNIQUE,
+        email VARCHAR(255),
+        product_name VARCHAR(255),
+        gumroad_data JSONB,
+        processed BOOLEAN DEFAULT FALSE,
+        processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+# purchases 表通常已由 init-db 创建，每个进程只在首次写入前确认一次
+purchases_table_ready = False
+
+def ensure_purchases_table():
+    """确保 purchases 表存在（DDL 不进入每次 webhook 的写入事务）"""
+    global purchases_table_ready
+    if purchases_table_ready:
+        return
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(CREATE_PURCHASES_TABLE_SQL)
+    purchases_table_ready = True
+
+def save_purchase_record(purchase_id, email, product_name, data):
+    """保存 Gumroad 购买记录到 purchases 表"""
+    if not config.DATABASE_URL or psycopg2 is None:
+        return False
+    
+    try:
+        ensure_purchases_table()
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                # 插入购买记录
+                prepare_statement(cursor, 'insert_purchase', INSERT_PURCHASE_SQL)
+                cursor.execute('EXECUTE insert_purchase (%s, %s, %s, %s)', (
+                    purchase_id,
+                    email,
+                    product_name,
+                    orjson.dumps(data).decode()
+                ))
+        
+        purchase_check_cache.pop(purchase_id)
+        logger.info("💾 购买记录保存成功: %s", purchase_id)
+        return True
+        
+    except Exception as db_error:
+        logger.warning("保存购买记录失败: %s", db_error)
+        return False
+
+def save_purchase_with_activation(purchase_id, email, product_name, data,
+                                  activation_code, activation_data):
+    """在一个事务、一条语句中保存购买记录和激活记录"""
+    try:
+        ensure_purchases_table()
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                prepare_statement(cursor, 'insert_purchase_activation', INSERT_PURCHASE_ACTIVATION_SQL)
+                cursor.execute(
+                    'EXECUTE insert_purchase_activation '
+                    '(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
+                    (purchase_id, email, product_name, orjson.dumps(data).decode())
+                    + activation_row(email, activation_code, activation_data)
+                )
+        
+        purchase_check_cache.pop(purchase_id)
+        logger.info("💾 购买记录和激活码保存到数据库: %s", purchase_id)
+        return True
+        
+    except Exception as db_error:
+        logger.warning("合并保存购买记录失败，改为分别保存: %s", db_error)
         return False
 
 def save_activation_record(email, activation_code, activation_data):
     """保存激活记录到数据库或文件"""
     try:
-        if config.DATABASE_URL:
+        if config.DATABASE_URL and psycopg2 is not None:
             return save_to_database(email, activation_code, activation_data)
         else:
             return save_to_file(email, activation_code, activation_data)
     except Exception as e:
-        logger.error(f"保存记录失败: {e}")
+        logger.error("保存记录失败: %s", e)
         return save_to_file(email, activation_code, activation_data)
 
+def activation_row(email, activation_code, activation_data):
+    """激活记录对应的 activations 表字段"""
+    return (
+        email,
+        activation_code,
+        activation_data['product_type'],
+        activation_data['days_valid'],
+        activation_data['max_devices'],
+        activation_data['valid_until'],
+        orjson.dumps(activation_data).decode()
+    )
+
+def insert_activation_rows(rows):
+    """写入一批激活记录：单条走预备语句，多条合并为一条 INSERT"""
+    with db_connection() as conn:
+        with conn.cursor() as cursor:
+            if len(rows) == 1:
+                prepare_statement(cursor, 'insert_activation', INSERT_ACTIVATION_SQL)
+                cursor.execute('EXECUTE insert_activation (%s, %s, %s, %s, %s, %s, %s)', rows[0])
+            else:
+                psycopg2.extras.execute_values(cursor, BATCH_INSERT_ACTIVATION_SQL, rows,
+                                               template=BATCH_INSERT_ACTIVATION_TEMPLATE,
+                                               page_size=len(rows))
+
+class ActivationBatchWriter:
+    """激活记录批量写入线程 - 并发到达的记录合并为一次数据库往返"""
+    
+    def __init__(self, max_batch=64):
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def submit(self, email, activation_code, activation_data):
+        """提交一条记录，返回 Future（结果为是否保存成功）"""
+        future = Future()
+        self._queue.put((email, activation_code, activation_data, future))
+        self._ensure_thread()
+        return future
+    
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name='activation-db-writer', daemon=True
+                    )
+                    self._thread.start()
+    
+    def _run(self):
+        while True:
+            # 阻塞等待第一条，再取走队列中已有的记录（不额外等待，不增加延迟）
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+    
+    def _write(self, batch):
+        try:
+            insert_activation_rows([
+                activation_row(email, code, data) for email, code, data, _ in batch
+            ])
+            logger.info("💾 %s 条激活码保存到数据库", len(batch))
+            for _, _, _, future in batch:
+                future.set_result(True)
+        except Exception as e:
+            logger.error("数据库保存失败: %s", e)
+            for email, code, data, future in batch:
+                future.set_result(save_to_file(email, code, data))
+
+activation_batch_writer = ActivationBatchWriter(max_batch=config.DB_BATCH_SIZE)
+
 def save_to_database(email, activation_code, activation_data):
-    """保存到数据库"""
+    """保存到数据库（经由批量写入线程）"""
+    return activation_batch_writer.submit(email, activation_code, activation_data).result()
+
+ACTIVATIONS_FILE = "activations.csv"
+ACTIVATIONS_CSV_HEADER = ['时间', '邮箱', '激活码', '产品类型', '有效期至', '最大设备数']
+
+# 激活记录文件句柄常驻，避免每条记录都 open/stat/close
+activation_file = None
+activation_writer = None
+activation_file_lock = threading.Lock()
+
+# 激活记录由单独的写入线程批量追加
+CSV_BATCH_SIZE = 128
+csv_queue = queue.Queue()
+csv_writer_thread = None
+csv_writer_lock = threading.Lock()
+
+def get_activation_writer():
+    """获取激活记录 CSV writer（调用方需持有 activation_file_lock）"""
+    global activation_file, activation_writer
+    if activation_file is None:
+        activation_file = open(ACTIVATIONS_FILE, 'a', newline='', encoding='utf-8',
+                               buffering=1 << 16)
+        activation_writer = csv.writer(activation_file)
+        if activation_file.tell() == 0:
+            activation_writer.writerow(ACTIVATIONS_CSV_HEADER)
+    return activation_writer
+
+def csv_writer_loop():
+    """写入线程：取出队列中已有的记录，一次写入并 flush"""
+    while True:
+        rows = [csv_queue.get()]
+        while len(rows) < CSV_BATCH_SIZE:
+            try:
+                rows.append(csv_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        try:
+            with activation_file_lock:
+                get_activation_writer().writerows(rows)
+                # 每批一次 write()，多个 worker 追加时整行写入且读取端立即可见（不 fsync）
+                activation_file.flush()
+            logger.info("📄 %s 条激活码保存到文件", len(rows))
+        except Exception as e:
+            logger.error("文件保存失败: %s", e)
+        finally:
+            for _ in rows:
+                csv_queue.task_done()
+
+def start_csv_writer():
+    """首次保存时启动写入线程（每个 worker 进程一个）"""
+    global csv_writer_thread
+    if csv_writer_thread is None:
+        with csv_writer_lock:
+            if csv_writer_thread is None:
+                csv_writer_thread = threading.Thread(
+                    target=csv_writer_loop, name='activation-csv-writer', daemon=True
+                )
+                csv_writer_thread.start()
+
+def close_activation_file():
+    """进程退出时写完排队的记录并关闭文件"""
+    if csv_writer_thread is not None:
+        csv_queue.join()
+    with activation_file_lock:
+        if activation_file is not None:
+            activation_file.close()
+
+# 在后台任务执行器之前注册，退出时晚于执行器运行（atexit 后进先出）
+atexit.register(close_activation_file)
+
+def save_to_file(email, activation_code, activation_data):
+    """保存到本地文件（排队后由写入线程批量追加）"""
     try:
-        import psycopg2
-        import psycopg2.extras
-        
-        conn = psycopg2.connect(config.DATABASE_URL)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO activations 
-        (email, activation_code, product_type, days_valid, max_devices, valid_until, metadata)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (activation_code) DO NOTHING
-        ''', (
+        # 记录时间取激活码生成时间（ISO 格式截到秒），不再单独取时钟
+        generated_at = activation_data.get('generated_at')
+        row = [
+            generated_at[:19].replace('T', ' ') if generated_at
+            else datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             email,
             activation_code,
             activation_data['product_type'],
-            activation_data['days_valid'],
-            activation_data['max_devices'],
-            activation_data['valid_until'],
-            json.dumps(activation_data)
-        ))
+            activation_data['valid_until'][:10],
+            activation_data['max_devices']
+        ]
         
-        conn.commit()
-        cursor.close()
-        conn.close()
+        start_csv_writer()
+        csv_queue.put(row)
         
-        logger.info(f"💾 激活码保存到数据库: {activation_code[:20]}...")
+        logger.info("📄 激活码已排队保存到文件: %s", activation_code)
         return True
         
     except Exception as e:
-        logger.error(f"数据库保存失败: {e}")
-        return save_to_file(email, activation_code, activation_data)
+        logger.error("文件保存失败: %s", e)
+        return False
 
-def save_to_file(email, activation_code, activation_data):
-    """保存到本地文件"""
+def tail_activation_file(limit, chunk_size=1 << 16):
+    """从文件末尾读取最近 limit 条激活记录（最新的在前），不读取整个文件"""
+    with open(ACTIVATIONS_FILE, 'rb', buffering=chunk_size) as f:
+        header = f.readline()
+        data_start = f.tell()
+        
+        # 从末尾向前按块读取，直到凑够 limit 行或读到表头
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        tail = b''
+        while position > data_start and tail.count(b'\n') <= limit:
+            position = max(data_start, position - chunk_size)
+            f.seek(position)
+            tail = f.read(end - position)
+    
+    lines = tail.splitlines()
+    if position > data_start:
+        # 第一行可能不完整
+        lines = lines[1:]
+    lines = lines[-limit:]
+    lines.reverse()
+    
+    text = b'\n'.join([header.rstrip(b'\r\n')] + lines).decode('utf-8')
+    return list(csv.DictReader(io.StringIO(text)))
+
+# ==================== 后台任务 ====================
+background_executor = ThreadPoolExecutor(
+    max_workers=config.BACKGROUND_WORKERS,
+    thread_name_prefix='activation-bg'
+)
+# 进程退出前等待已排队的任务完成
+atexit.register(background_executor.shutdown, wait=True)
+
+def deliver_activation(email, activation_code, activation_data, save_success=None):
+    """后台任务：保存激活记录（调用方已保存时跳过）并发送激活邮件"""
     try:
-        import csv
+        if save_success is None:
+            save_success = save_activation_record(email, activation_code, activation_data)
+        email_sent = send_activation_email(email, activation_code, activation_data)
         
-        filename = "activations.csv"
-        file_exists = os.path.exists(filename)
-        
-        with open(filename, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            if not file_exists:
-                writer.writerow(['时间', '邮箱', '激活码', '产品类型', '有效期至', '最大设备数'])
-            
-            writer.writerow([
-                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                email,
-                activation_code,
-                activation_data['product_type'],
-                activation_data['valid_until'][:10],
-                activation_data['max_devices']
-            ])
-        
-        logger.info(f"📄 激活码保存到文件: {activation_code}")
-        return True
+        logger.info("📬 后台处理完成: %s", email)
+        logger.info("   📤 邮件状态: %s", '✅ 已发送' if email_sent else '❌ 发送失败')
+        logger.info("   💾 保存状态: %s", '✅ 成功' if save_success else '❌ 失败')
+        return save_success, email_sent
         
     except Exception as e:
-        logger.error(f"文件保存失败: {e}")
+        logger.error("❌ 后台处理激活失败: %s", e, exc_info=True)
+        return False, False
+
+def save_purchase(purchase_id, email, product_name, data, activation_code, activation_data):
+    """保存 Gumroad 购买记录和激活记录，返回激活记录是否保存成功"""
+    try:
+        if (config.DATABASE_URL and psycopg2 is not None
+                and save_purchase_with_activation(purchase_id, email, product_name, data,
+                                                  activation_code, activation_data)):
+            return True
+        # 合并写入失败或未配置数据库时分别保存；购买记录保存失败不影响激活码发放
+        save_purchase_record(purchase_id, email, product_name, data)
+        return save_activation_record(email, activation_code, activation_data)
+    except Exception as e:
+        logger.error("❌ 保存购买失败: %s", e, exc_info=True)
         return False
 
-# ==================== 心跳保持 ====================
-def keep_service_awake():
-    """定时访问服务防止休眠"""
-    service_url = "https://pdf-email-1.onrender.com/health"
+# ==================== API 路由 ====================
+
+# 主页响应中除时间戳外的内容在启动后不再变化，只构建一次
+HOME_PAYLOAD = {
+    "service": "PDF Fusion Pro 激活服务器",
+    "version": "2.0.0",
+    "status": "运行中",
+    "storage": "数据库" if config.DATABASE_URL else "文件",
+    "email_configured": smtp_configured,
+    "encryption_configured": cipher is not None,
+    "endpoints": {
+        "health": "/health",
+        "status": "/api/status",
+        "generate": "/api/generate",
+        "verify": "/api/verify",
+        "webhook": "/api/webhook/gumroad",
+        "manual_activate": "/api/manual-activate",
+        "debug_webhook": "/api/debug/webhook",
+        "check_purchase": "/api/check-purchase/<sale_id>",
+        "check_activation": "/api/check-activation/<activation_code>",
+        "list_purchases": "/api/list-purchases",
+        "list_activations": "/api/admin/activations"
+    }
+}
+# 预先序列化，每次请求只拼接时间戳
+HOME_BODY_PREFIX = orjson.dumps(HOME_PAYLOAD)[:-1] + b',"timestamp":"'
+
+# 健康检查的数据库探测结果缓存（秒），避免负载均衡探活频繁连接数据库
+HEALTH_DB_TTL = 5
+health_db_cache = {"status": None, "checked_at": 0.0}
+health_db_lock = threading.Lock()
+
+def probe_database():
+    """探测数据库连接状态（结果缓存 HEALTH_DB_TTL 秒），返回 (状态, 是否来自缓存)"""
+    if not config.DATABASE_URL:
+        return "未配置", False
     
-    while True:
+    # 持锁探测：缓存过期时并发的健康检查只触发一次探测
+    with health_db_lock:
+        now = time.monotonic()
+        if health_db_cache["status"] and now - health_db_cache["checked_at"] < HEALTH_DB_TTL:
+            return health_db_cache["status"], True
+        
         try:
-            time.sleep(300)  # 每5分钟执行一次
-            
-            import requests
-            response = requests.get(service_url, timeout=10)
-            logger.info(f"💓 心跳保持: {response.status_code}")
-            
+            with db_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+            db_status = "连接正常"
         except Exception as e:
-            logger.error(f"心跳失败: {e}")
+            logger.error("数据库连接失败: %s", e)
+            db_status = "连接失败"
+        
+        health_db_cache["status"] = db_status
+        health_db_cache["checked_at"] = now
+        return db_status, False
 
-# ==================== API 路由 ====================
+# /api/status 的系统指标采样缓存（秒）；主机名启动后不会变化
+STATUS_SAMPLE_TTL = 5
+HOSTNAME = socket.gethostname()
+status_sample_cache = {"sample": None, "sampled_at": 0.0}
+status_sample_lock = threading.Lock()
+
+def sample_system_metrics():
+    """读取 (CPU 占用, 内存占用)，结果缓存 STATUS_SAMPLE_TTL 秒"""
+    with status_sample_lock:
+        now = time.monotonic()
+        if status_sample_cache["sample"] and now - status_sample_cache["sampled_at"] < STATUS_SAMPLE_TTL:
+            return status_sample_cache["sample"]
+        
+        # cpu_percent() 返回距上次调用以来的平均值，采样间隔即缓存时长
+        sample = (psutil.cpu_percent(), psutil.virtual_memory().percent)
+        status_sample_cache["sample"] = sample
+        status_sample_cache["sampled_at"] = now
+        return sample
 
 @app.route('/')
 def home():
     """主页"""
-    storage_type = "数据库" if config.DATABASE_URL else "文件"
-    
-    return jsonify({
-        "service": "PDF Fusion Pro 激活服务器",
-        "version": "2.0.0",
-        "status": "运行中",
-        "timestamp": datetime.now().isoformat(),
-        "storage": storage_type,
-        "email_configured": smtp_configured,
-        "encryption_configured": cipher is not None,
-        "endpoints": {
-            "health": "/health",
-            "status": "/api/status",
-            "generate": "/api/generate",
-            "verify": "/api/verify",
-            "webhook": "/api/webhook/gumroad",
-            "manual_activate": "/api/manual-activate",
-            "debug_webhook": "/api/debug/webhook",
-            "check_purchase": "/api/check-purchase/<sale_id>",
-            "check_activation": "/api/check-activation/<activation_code>",
-            "list_purchases": "/api/list-purchases",
-            "list_activations": "/api/admin/activations"
-        }
-    })
+    body = HOME_BODY_PREFIX + datetime.now().isoformat().encode() + b'"}'
+    return app.response_class(body, mimetype='application/json')
 
 @app.route('/health')
 def health_check():
     """健康检查"""
     try:
-        # 测试数据库连接
-        db_status = "未配置"
-        if config.DATABASE_URL:
-            try:
-                import psycopg2
-                conn = psycopg2.connect(config.DATABASE_URL)
-                conn.close()
-                db_status = "连接正常"
-            except Exception as e:
-                logger.error(f"数据库连接失败: {e}")
-                db_status = "连接失败"
+        # 测试数据库连接（短时缓存）
+        db_status, db_status_cached = probe_database()
         
         # 邮件服务状态
-        email_status = "未配置"
-        if smtp_configured:
-            email_status = "已配置"
+        email_status = "已配置" if smtp_configured else "未配置"
         
         # 加密状态
         encryption_status = "已启用" if cipher else "未启用"
@@ -631,9 +1183,10 @@ def health_check():
         
         return jsonify({
             "status": "healthy",
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": datetime.now(),
             "uptime": uptime_str,
             "database": db_status,
+            "database_cached": db_status_cached,
             "email_service": email_status,
             "encryption": encryption_status,
             "version": "2.0.0",
@@ -642,26 +1195,27 @@ def health_check():
         })
         
     except Exception as e:
-        logger.error(f"健康检查失败: {e}")
+        logger.error("健康检查失败: %s", e)
         return jsonify({
             "status": "unhealthy",
             "error": str(e),
-            "timestamp": datetime.now().isoformat()
+            "timestamp": datetime.now()
         }), 500
 
 @app.route('/api/status', methods=['GET'])
 def server_status():
     """服务器实时状态"""
     try:
-        import psutil
-        import socket
+        if psutil is None:
+            return jsonify({"error": "未安装 psutil，无法获取服务器状态"}), 500
         
+        cpu_percent, memory_percent = sample_system_metrics()
         status = {
             "server": {
-                "hostname": socket.gethostname(),
+                "hostname": HOSTNAME,
                 "uptime": time.time() - app_start_time,
-                "cpu_percent": psutil.cpu_percent(),
-                "memory_percent": psutil.virtual_memory().percent
+                "cpu_percent": cpu_percent,
+                "memory_percent": memory_percent
             },
             "service": {
                 "webhook_endpoint": "/api/webhook/gumroad",
@@ -684,7 +1238,7 @@ def server_status():
         return jsonify(status)
         
     except Exception as e:
-        logger.error(f"获取状态失败: {e}")
+        logger.error("获取状态失败: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # ==================== Gumroad Webhook 处理 ====================
@@ -694,17 +1248,18 @@ def webhook_gumroad():
     global last_webhook_time, webhook_count
     
     try:
-        last_webhook_time = datetime.now().isoformat()
+        received_at = datetime.now()
+        last_webhook_time = received_at
         webhook_count += 1
         
         logger.info("=" * 60)
-        logger.info(f"📨 🎯 收到 Gumroad Webhook 请求 #{webhook_count}")
-        logger.info(f"📋 Content-Type: {request.content_type}")
-        logger.info(f"📤 用户代理: {request.user_agent}")
+        logger.info("📨 🎯 收到 Gumroad Webhook 请求 #%s", webhook_count)
+        logger.info("📋 Content-Type: %s", request.content_type)
+        logger.info("📤 用户代理: %s", request.user_agent)
         
         # 获取原始数据
         raw_data = request.get_data(as_text=True)
-        logger.info(f"📄 原始数据长度: {len(raw_data)} 字符")
+        logger.info("📄 原始数据长度: %s 字符", len(raw_data))
         
         # 解析数据
         data = {}
@@ -714,18 +1269,18 @@ def webhook_gumroad():
             data = parse_form_data(raw_data)
         elif request.content_type == 'application/json':
             logger.info("🔄 解析 JSON 格式")
-            data = request.json
+            data = request.get_json(silent=True) or {}
         else:
             # 尝试自动检测
-            try:
-                data = request.json
+            data = request.get_json(silent=True)
+            if data is not None:
                 logger.info("✅ 自动解析为 JSON")
-            except:
+            else:
                 try:
                     data = parse_form_data(raw_data)
                     logger.info("✅ 自动解析为 form-urlencoded")
                 except Exception as e:
-                    logger.error(f"❌ 无法解析数据: {e}")
+                    logger.error("❌ 无法解析数据: %s", e)
                     return jsonify({
                         "error": f"无法解析请求数据，Content-Type: {request.content_type}",
                         "supported_types": ["application/json", "application/x-www-form-urlencoded"]
@@ -736,7 +1291,7 @@ def webhook_gumroad():
             return jsonify({"error": "无法解析请求数据"}), 400
         
         # 日志数据内容
-        logger.info(f"📊 解析后的数据字段: {list(data.keys())}")
+        logger.info("📊 解析后的数据字段: %s", list(data.keys()))
         
         # 提取关键信息
         email = data.get('email')
@@ -744,120 +1299,87 @@ def webhook_gumroad():
         sale_id = data.get('sale_id')
         order_number = data.get('order_number')
         
-        logger.info(f"🔍 关键信息:")
-        logger.info(f"   📧 Email: {email}")
-        logger.info(f"   📦 Product: {product_name}")
-        logger.info(f"   🆔 Sale ID: {sale_id}")
-        logger.info(f"   🧾 Order: {order_number}")
+        logger.info("🔍 关键信息:")
+        logger.info("   📧 Email: %s", email)
+        logger.info("   📦 Product: %s", product_name)
+        logger.info("   🆔 Sale ID: %s", sale_id)
+        logger.info("   🧾 Order: %s", order_number)
         
         # 验证必要字段
         if not email:
             logger.error("❌ 缺少邮箱地址")
             return jsonify({"error": "邮箱地址缺失"}), 400
         
-        # 确定产品类型
-        product_name_lower = product_name.lower()
-        product_type = 'personal'
+        # 重试的 webhook 直接返回首次生成的激活码，不再生成、保存和发信
+        dedup_key = sale_id if isinstance(sale_id, str) else None
+        if dedup_key:
+            previous = processed_sales.get(dedup_key)
+            if previous is not None:
+                logger.info("♻️  重复的 Webhook，已处理过: %s", dedup_key)
+                return jsonify({**previous, "duplicate": True}), 200
         
-        if 'business' in product_name_lower:
-            product_type = 'business'
-        elif 'enterprise' in product_name_lower:
-            product_type = 'enterprise'
-        elif 'professional' in product_name_lower:
-            product_type = 'professional'
+        # 确定产品类型
+        product_type = detect_product_type(product_name)
         
-        logger.info(f"🏷️  产品类型: {product_type}")
+        logger.info("🏷️  产品类型: %s", product_type)
         
         # 使用 sale_id 作为购买ID
-        purchase_id = sale_id or order_number or f"gumroad_{int(datetime.now().timestamp())}"
+        purchase_id = sale_id or order_number or f"gumroad_{int(received_at.timestamp())}"
         
         # 生成激活码
-        logger.info(f"🔑 开始生成激活码...")
+        logger.info("🔑 开始生成激活码...")
         activation_code, activation_data = generate_professional_activation_code(
             email=email,
             product_type=product_type,
             purchase_id=purchase_id,
-            product_name=product_name
+            product_name=product_name,
+            now=received_at
         )
         
-        logger.info(f"✅ 激活码生成完成: {activation_code[:30]}...")
+        logger.info("✅ 激活码生成完成: %.30s...", activation_code)
         
-        # 保存购买记录到 purchases 表
-        try:
-            if config.DATABASE_URL:
-                import psycopg2
-                
-                conn = psycopg2.connect(config.DATABASE_URL)
-                cursor = conn.cursor()
-                
-                # 确保 purchases 表存在
-                cursor.execute('''
-                CREATE TABLE IF NOT EXISTS purchases (
-                    id SERIAL PRIMARY KEY,
-                    purchase_id VARCHAR(255) UNIQUE,
-                    email VARCHAR(255),
-                    product_name VARCHAR(255),
-                    gumroad_data JSONB,
-                    processed BOOLEAN DEFAULT FALSE,
-                    processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-                ''')
-                
-                # 插入购买记录
-                cursor.execute('''
-                INSERT INTO purchases (purchase_id, email, product_name, gumroad_data, processed)
-                VALUES (%s, %s, %s, %s, TRUE)
-                ON CONFLICT (purchase_id) 
-                DO UPDATE SET 
-                    processed = TRUE,
-                    processed_at = CURRENT_TIMESTAMP
-                ''', (
-                    purchase_id,
-                    email,
-                    product_name,
-                    json.dumps(data)
-                ))
-                
-                conn.commit()
-                conn.close()
-                logger.info(f"💾 购买记录保存成功: {purchase_id}")
-                
-        except Exception as db_error:
-            logger.warning(f"保存购买记录失败: {db_error}")
-            # 不影响主要功能，继续处理
-        
-        # 保存激活记录
-        save_success = save_activation_record(email, activation_code, activation_data)
+        response_data = {
+            "success": True,
+            "message": "激活码已生成，邮件将在后台发送",
+            "activation_code": activation_code,
+            "email": email,
+            "product_type": product_type,
+            "queued": True
+        }
         
-        # 发送邮件
-        email_sent = False
-        if activation_code:
-            logger.info(f"📤 准备发送邮件到: {email}")
-            email_sent = send_activation_email(email, activation_code, activation_data)
+        # 并发到达的同一 sale_id 只处理先记录的一个
+        if dedup_key:
+            previous = processed_sales.put_if_absent(dedup_key, response_data)
+            if previous is not None:
+                logger.info("♻️  重复的 Webhook，已处理过: %s", dedup_key)
+                return jsonify({**previous, "duplicate": True}), 200
+        
+        # 记录保存后才返回 2xx：Gumroad 不会重试成功响应，保存失败必须让它重试
+        if not save_purchase(purchase_id, email, product_name, data,
+                             activation_code, activation_data):
+            if dedup_key:
+                processed_sales.pop(dedup_key)
+            logger.error("❌ 激活记录保存失败，等待 Gumroad 重试: %s", purchase_id)
+            return jsonify({"error": "激活记录保存失败，请稍后重试"}), 503
+        
+        # 邮件发送放到后台执行，尽快响应 Gumroad
+        logger.info("📤 激活邮件发送已排队: %s", email)
+        background_executor.submit(
+            deliver_activation, email, activation_code, activation_data, save_success=True
+        )
         
         # 记录处理结果
         logger.info("=" * 60)
-        logger.info(f"🎉 Gumroad Webhook 处理完成")
-        logger.info(f"   📧 邮箱: {email}")
-        logger.info(f"   🏷️  产品: {product_name}")
-        logger.info(f"   🔑 激活码: {activation_code[:20]}...")
-        logger.info(f"   📤 邮件状态: {'✅ 已发送' if email_sent else '❌ 发送失败'}")
-        logger.info(f"   💾 保存状态: {'✅ 成功' if save_success else '❌ 失败'}")
+        logger.info("🎉 Gumroad Webhook 处理完成")
+        logger.info("   📧 邮箱: %s", email)
+        logger.info("   🏷️  产品: %s", product_name)
+        logger.info("   🔑 激活码: %.20s...", activation_code)
         logger.info("=" * 60)
         
-        return jsonify({
-            "success": True,
-            "message": "激活码已生成" + ("并发送" if email_sent else "（但邮件发送失败）"),
-            "activation_code": activation_code,
-            "email": email,
-            "product_type": product_type,
-            "email_sent": email_sent,
-            "save_success": save_success
-        })
+        return jsonify(response_data), 202
         
     except Exception as e:
-        logger.error(f"❌ Webhook处理失败: {e}", exc_info=True)
+        logger.error("❌ Webhook处理失败: %s", e, exc_info=True)
         return jsonify({"error": str(e)}), 500
 
 # ==================== 调试和监控端点 ====================
@@ -867,16 +1389,19 @@ def debug_webhook():
     try:
         logger.info("=" * 60)
         logger.info("🐛 调试 Webhook 请求")
-        logger.info(f"📋 请求头: {dict(request.headers)}")
         
-        raw_data = request.get_data(as_text=True)
+        # 原始数据只读取一次，JSON 直接从字节解析
+        raw_bytes = request.get_data()
+        raw_data = raw_bytes.decode('utf-8', errors='replace')
         content_type = request.content_type
+        headers = dict(request.headers)
+        logger.info("📋 请求头: %s", headers)
         
         result = {
             "method": request.method,
             "content_type": content_type,
             "raw_data": raw_data,
-            "headers": dict(request.headers)
+            "headers": headers
         }
         
         # 尝试解析
@@ -884,25 +1409,27 @@ def debug_webhook():
             result['parsed_data'] = parse_form_data(raw_data)
         elif content_type == 'application/json':
             try:
-                result['parsed_data'] = request.json
-            except:
+                result['parsed_data'] = orjson.loads(raw_bytes)
+            except orjson.JSONDecodeError:
                 result['parsed_data'] = "无法解析为JSON"
         else:
             result['parsed_data'] = "未知格式"
         
-        logger.info(f"📊 解析结果: {json.dumps(result, indent=2, ensure_ascii=False)[:500]}...")
+        if logger.isEnabledFor(logging.INFO):
+            # 只记录前 500 字符（UTF-8 每字符至多 4 字节，只需解码前 2000 字节），不缩进
+            logger.info("📊 解析结果: %.500s...", orjson.dumps(result)[:2000].decode('utf-8', errors='ignore'))
         
         return jsonify(result)
         
     except Exception as e:
-        logger.error(f"❌ 调试Webhook失败: {e}")
+        logger.error("❌ 调试Webhook失败: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/check-purchase/<sale_id>', methods=['GET'])
 def check_purchase(sale_id):
     """检查购买是否已处理"""
     try:
-        logger.info(f"🔍 检查购买记录: {sale_id}")
+        logger.info("🔍 检查购买记录: %s", sale_id)
         
         if not config.DATABASE_URL:
             return jsonify({
@@ -911,40 +1438,49 @@ def check_purchase(sale_id):
                 "note": "无法检查购买记录"
             })
         
-        import psycopg2
-        import psycopg2.extras
-        
-        conn = psycopg2.connect(config.DATABASE_URL)
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        # 检查 purchases 表
-        cursor.execute('''
-        SELECT * FROM purchases WHERE purchase_id = %s
-        ''', (sale_id,))
-        purchase = cursor.fetchone()
-        
-        # 检查 activations 表
-        cursor.execute('''
-        SELECT email, activation_code, product_type, generated_at, metadata 
-        FROM activations 
-        WHERE metadata::jsonb->>'purchase_id' = %s 
-           OR metadata::jsonb->>'sale_id' = %s
-        ''', (sale_id, sale_id))
-        activation = cursor.fetchone()
-        
-        conn.close()
+        details = request.args.get('details', '1') != '0'
+        
+        # 两条记录都已存在时结果不再变化，才会进入缓存
+        cached = purchase_check_cache.get(sale_id)
+        if cached is not None:
+            purchase, activation = cached
+        elif not details:
+            with db_connection() as conn:
+                with conn.cursor() as cursor:
+                    prepare_statement(cursor, 'purchase_exists', PURCHASE_EXISTS_SQL)
+                    cursor.execute('EXECUTE purchase_exists (%s)', (sale_id,))
+                    purchase, activation = cursor.fetchone()
+        else:
+            with db_connection() as conn:
+                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                    # 检查 purchases 表
+                    prepare_statement(cursor, 'select_purchase', SELECT_PURCHASE_SQL)
+                    cursor.execute('EXECUTE select_purchase (%s)', (sale_id,))
+                    purchase = cursor.fetchone()
+                    
+                    # 检查 activations 表
+                    prepare_statement(cursor, 'select_activation_by_purchase',
+                                      SELECT_ACTIVATION_BY_PURCHASE_SQL)
+                    cursor.execute('EXECUTE select_activation_by_purchase (%s)', (sale_id,))
+                    activation = cursor.fetchone()
+            
+            if purchase and activation:
+                purchase_check_cache.put_if_absent(sale_id, (purchase, activation))
         
-        return jsonify({
+        result = {
             "sale_id": sale_id,
             "purchase_record_found": bool(purchase),
-            "activation_record_found": bool(activation),
-            "purchase_details": purchase,
-            "activation_details": activation,
-            "checked_at": datetime.now().isoformat()
-        })
+            "activation_record_found": bool(activation)
+        }
+        if details:
+            result["purchase_details"] = purchase
+            result["activation_details"] = activation
+        result["checked_at"] = datetime.now()
+        
+        return jsonify(result)
         
     except Exception as e:
-        logger.error(f"❌ 检查购买失败: {e}")
+        logger.error("❌ 检查购买失败: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/check-activation/<activation_code>', methods=['GET'])
@@ -957,33 +1493,49 @@ def check_activation(activation_code):
                 "activation_code": activation_code
             })
         
-        import psycopg2
-        import psycopg2.extras
-        
-        conn = psycopg2.connect(config.DATABASE_URL)
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        cursor.execute('''
-        SELECT * FROM activations WHERE activation_code = %s
-        ''', (activation_code,))
-        
-        activation = cursor.fetchone()
-        conn.close()
+        details = request.args.get('details', '1') != '0'
+        
+        # 激活记录写入后不再修改，命中缓存直接返回
+        activation = activation_check_cache.get(activation_code)
+        if activation is not None:
+            found = True
+        elif details:
+            with db_connection() as conn:
+                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                    prepare_statement(cursor, 'select_activation', SELECT_ACTIVATION_SQL)
+                    cursor.execute('EXECUTE select_activation (%s)', (activation_code,))
+                    
+                    activation = cursor.fetchone()
+            
+            found = activation is not None
+            if found:
+                activation_check_cache.put_if_absent(activation_code, activation)
+        else:
+            with db_connection() as conn:
+                with conn.cursor() as cursor:
+                    prepare_statement(cursor, 'activation_exists', ACTIVATION_EXISTS_SQL)
+                    cursor.execute('EXECUTE activation_exists (%s)', (activation_code,))
+                    found = cursor.fetchone()[0]
         
-        if activation:
+        if not found:
+            return jsonify({
+                "found": False,
+                "activation_code": activation_code,
+                "message": "未找到该激活码"
+            })
+        elif details:
             return jsonify({
                 "found": True,
                 "activation": activation
             })
         else:
             return jsonify({
-                "found": False,
-                "activation_code": activation_code,
-                "message": "未找到该激活码"
+                "found": True,
+                "activation_code": activation_code
             })
         
     except Exception as e:
-        logger.error(f"❌ 检查激活码失败: {e}")
+        logger.error("❌ 检查激活码失败: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/list-purchases', methods=['GET'])
@@ -997,28 +1549,23 @@ def list_purchases():
                 "note": "使用文件存储，无法列出购买记录"
             })
         
-        import psycopg2
-        import psycopg2.extras
-        
-        conn = psycopg2.connect(config.DATABASE_URL)
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        
-        cursor.execute('''
-        SELECT 
-            purchase_id, 
-            email, 
-            product_name, 
-            processed, 
-            processed_at, 
-            created_at,
-            LENGTH(gumroad_data::text) as data_length
-        FROM purchases 
-        ORDER BY processed_at DESC 
-        LIMIT 50
-        ''')
-        
-        purchases = cursor.fetchall()
-        conn.close()
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.execute('''
+                SELECT 
+                    purchase_id, 
+                    email, 
+                    product_name, 
+                    processed, 
+                    processed_at, 
+                    created_at,
+                    LENGTH(gumroad_data::text) as data_length
+                FROM purchases 
+                ORDER BY processed_at DESC 
+                LIMIT 50
+                ''')
+                
+                purchases = cursor.fetchall()
         
         return jsonify({
             "success": True,
@@ -1027,7 +1574,7 @@ def list_purchases():
         })
         
     except Exception as e:
-        logger.error(f"❌ 列出购买记录失败: {e}")
+        logger.error("❌ 列出购买记录失败: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # ==================== 管理端点 ====================
@@ -1036,7 +1583,7 @@ def list_purchases():
 def api_generate():
     """生成激活码"""
     try:
-        data = request.json
+        data = request.get_json(silent=True) or {}
         
         # 验证输入
         email = data.get('email')
@@ -1051,7 +1598,7 @@ def api_generate():
         # 保存记录
         save_activation_record(email, activation_code, activation_data)
         
-        logger.info(f"✅ 生成激活码: {email} -> {activation_code}")
+        logger.info("✅ 生成激活码: %s -> %s", email, activation_code)
         
         return jsonify({
             "success": True,
@@ -1061,43 +1608,103 @@ def api_generate():
         })
         
     except Exception as e:
-        logger.error(f"生成激活码失败: {e}")
+        logger.error("生成激活码失败: %s", e)
         return jsonify({"error": "服务器错误"}), 500
 
+# 简单激活码: PDF-<类型><月日>-<邮箱哈希>-<随机>-<随机>
+SIMPLE_CODE_PATTERN = re.compile(r'PDF-([PRBE])\d{4}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{4}')
+# 专业激活码: 十六进制 8 位一组，分隔符 - 可省略
+PROFESSIONAL_CODE_PATTERN = re.compile(
+    r'(?:[0-9A-Fa-f]{%d}-?){%d}[0-9A-Fa-f]{%d}' % (CODE_GROUP_SIZE, CODE_GROUP_COUNT - 1, CODE_GROUP_SIZE)
+)
+# 旧版激活码: Fernet 令牌再做一次 Base64 后截取的 6 组 8 位（以 "gAAAAA" 编码后的 Z0FBQUFB 开头）
+LEGACY_CODE_PATTERN = re.compile(r'Z0FBQUFB(?:-[A-Za-z0-9_-]{8}){5}')
+TYPE_CODE_PRODUCTS = {code: product_type for product_type, code in TYPE_CODES.items()}
+
+def find_legacy_activation(activation_code):
+    """旧版激活码被截断、无法解密，只能按已保存的激活记录验证
+    
+    返回 (产品类型, 到期日)；没有记录时返回 None。数据库查询出错时抛出异常，
+    避免把"未找到"写入 parse_activation_code 的缓存
+    """
+    if config.DATABASE_URL and psycopg2 is not None:
+        with db_connection() as conn:
+            with conn.cursor() as cursor:
+                prepare_statement(cursor, 'select_activation_validity',
+                                  SELECT_ACTIVATION_VALIDITY_SQL)
+                cursor.execute('EXECUTE select_activation_validity (%s)', (activation_code,))
+                row = cursor.fetchone()
+        if row is not None:
+            return row[0], row[1].date()
+    
+    # 数据库写入失败的记录会降级保存到文件
+    if os.path.exists(ACTIVATIONS_FILE):
+        with open(ACTIVATIONS_FILE, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                if row['激活码'] == activation_code:
+                    return row['产品类型'], date.fromisoformat(row['有效期至'])
+    return None
+
+@lru_cache(maxsize=8192)
+def parse_activation_code(activation_code):
+    """解析激活码，返回 (产品类型, 有效天数, 最大设备数, 到期日或 None)；无效时返回 None"""
+    match = SIMPLE_CODE_PATTERN.fullmatch(activation_code)
+    if match:
+        product_type = TYPE_CODE_PRODUCTS[match.group(1)]
+        valid_until = None
+    elif PROFESSIONAL_CODE_PATTERN.fullmatch(activation_code):
+        # 解密结果随激活码缓存，重复验证不再做 AES 运算
+        decoded = decode_professional_code(activation_code)
+        if decoded is None:
+            return None
+        product_type, valid_until = decoded
+    elif LEGACY_CODE_PATTERN.fullmatch(activation_code):
+        found = find_legacy_activation(activation_code)
+        if found is None:
+            return None
+        product_type, valid_until = found
+        if product_type not in PRODUCT_PARAMS:
+            # 早期记录的产品类型可能不规范，按个人版处理
+            product_type = 'personal'
+    else:
+        return None
+    
+    days_valid, max_devices = PRODUCT_PARAMS[product_type]
+    return product_type, days_valid, max_devices, valid_until
+
 @app.route('/api/verify', methods=['POST'])
 def api_verify():
     """验证激活码"""
     try:
-        data = request.json
+        data = request.get_json(silent=True) or {}
         
         # 验证输入
         activation_code = data.get('activation_code')
         device_id = data.get('device_id', 'unknown')
         device_name = data.get('device_name', 'Unknown Device')
         
-        if not activation_code:
+        if not activation_code or not isinstance(activation_code, str):
             return jsonify({"error": "激活码是必需的"}), 400
         
-        # 基本格式验证
-        #if not activation_code.startswith("PDF-"):
-        #    return jsonify({
-        #        "valid": False,
-        #        "message": "无效的激活码格式"
-        #    })
+        # 格式验证并提取产品类型（同一激活码重复验证时命中缓存）
+        parsed = parse_activation_code(activation_code)
+        if parsed is None:
+            return jsonify({
+                "valid": False,
+                "message": "无效的激活码格式"
+            })
         
-        # 提取产品类型
-        product_type = 'personal'
-        if len(activation_code) > 4:
-            code_char = activation_code[4]
-            if code_char == 'B':
-                product_type = 'business'
-            elif code_char == 'E':
-                product_type = 'enterprise'
+        product_type, days_valid, max_devices, valid_until = parsed
+        now = datetime.now()
         
-        # 模拟验证结果
-        max_devices = 3 if product_type == "personal" else 10
+        if valid_until is not None and valid_until < now.date():
+            return jsonify({
+                "valid": False,
+                "message": "激活码已过期",
+                "valid_until": valid_until
+            })
         
-        logger.info(f"✅ 验证激活码: {activation_code} -> {device_id}")
+        logger.info("✅ 验证激活码: %s -> %s", activation_code, device_id)
         
         return jsonify({
             "valid": True,
@@ -1105,14 +1712,14 @@ def api_verify():
             "data": {
                 "product_type": product_type,
                 "max_devices": max_devices,
-                "valid_until": (datetime.now() + timedelta(days=365)).isoformat(),
+                "valid_until": valid_until or (now + timedelta(days=days_valid)).date(),
                 "device_id": device_id,
                 "device_name": device_name
             }
         })
         
     except Exception as e:
-        logger.error(f"验证激活码失败: {e}")
+        logger.error("验证激活码失败: %s", e)
         return jsonify({"error": "服务器错误"}), 500
 
 @app.route('/api/manual-activate', methods=['POST'])
@@ -1121,7 +1728,7 @@ def manual_activate():
     try:
         logger.info("🛠️  收到手动激活请求")
         
-        data = request.json
+        data = request.get_json(silent=True) or {}
         
         # 验证必要字段
         required_fields = ['email', 'product_name']
@@ -1138,30 +1745,24 @@ def manual_activate():
         product_name = data['product_name']
         
         # 使用提供的购买ID或生成一个
-        purchase_id = data.get('purchase_id', f"manual_{int(datetime.now().timestamp())}")
+        now = datetime.now()
+        purchase_id = data.get('purchase_id', f"manual_{int(now.timestamp())}")
         
         # 判断产品类型
-        product_name_lower = product_name.lower()
-        product_type = 'personal'
-        
-        if 'business' in product_name_lower:
-            product_type = 'business'
-        elif 'enterprise' in product_name_lower:
-            product_type = 'enterprise'
-        elif 'professional' in product_name_lower:
-            product_type = 'professional'
+        product_type = detect_product_type(product_name)
         
-        logger.info(f"🛠️  手动激活参数:")
-        logger.info(f"   📧 邮箱: {email}")
-        logger.info(f"   🏷️  产品: {product_name} ({product_type})")
-        logger.info(f"   🆔 购买ID: {purchase_id}")
+        logger.info("🛠️  手动激活参数:")
+        logger.info("   📧 邮箱: %s", email)
+        logger.info("   🏷️  产品: %s (%s)", product_name, product_type)
+        logger.info("   🆔 购买ID: %s", purchase_id)
         
         # 生成激活码
         activation_code, activation_data = generate_professional_activation_code(
             email=email,
             product_type=product_type,
             purchase_id=purchase_id,
-            product_name=product_name
+            product_name=product_name,
+            now=now
         )
         
         # 保存激活码
@@ -1186,75 +1787,115 @@ def manual_activate():
         })
         
     except Exception as e:
-        logger.error(f"❌ 手动激活失败: {e}")
+        logger.error("❌ 手动激活失败: %s", e)
         return jsonify({"error": str(e)}), 500
 
+# 激活码列表条数：?limit=N，限制在 1..LIST_MAX_LIMIT 之间
+LIST_DEFAULT_LIMIT = 50
+LIST_MAX_LIMIT = 500
+
 @app.route('/api/admin/activations', methods=['GET'])
 @require_api_key
 def list_activations():
-    """列出激活码"""
+    """列出最近的激活码（流式输出）"""
     try:
-        activations = []
+        # 非整数时使用默认值
+        limit = request.args.get('limit', LIST_DEFAULT_LIMIT, type=int)
+        limit = max(1, min(limit, LIST_MAX_LIMIT))
+        activations = iter(())
+        first = None
         
         if config.DATABASE_URL:
             # 从数据库读取
             try:
-                import psycopg2
-                import psycopg2.extras
-                
-                conn = psycopg2.connect(config.DATABASE_URL)
-                cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-                
-                cursor.execute('''
-                SELECT email, activation_code, product_type, generated_at 
-                FROM activations 
-                ORDER BY generated_at DESC 
-                LIMIT 50
-                ''')
-                
-                activations = cursor.fetchall()
-                conn.close()
-                
+                activations = iter_db_activations(limit)
+                first = next(activations, None)
             except Exception as db_error:
-                logger.error(f"数据库查询失败: {db_error}")
+                logger.error("数据库查询失败: %s", db_error)
         
         # 如果数据库为空或失败，尝试从文件读取
-        if not activations:
+        if first is None:
+            activations = iter(())
             try:
-                import csv
-                filename = "activations.csv"
-                
-                if os.path.exists(filename):
-                    with open(filename, 'r', encoding='utf-8') as f:
-                        reader = csv.DictReader(f)
-                        activations = list(reader)
+                if os.path.exists(ACTIVATIONS_FILE):
+                    activations = iter(tail_activation_file(limit))
+                    first = next(activations, None)
             except Exception as file_error:
-                logger.error(f"文件读取失败: {file_error}")
+                logger.error("文件读取失败: %s", file_error)
         
-        return jsonify({
-            "success": True,
-            "count": len(activations),
-            "activations": activations,
-            "source": "database" if config.DATABASE_URL else "file"
-        })
+        rows = activations if first is None else itertools.chain((first,), activations)
+        source = "database" if config.DATABASE_URL else "file"
+        return app.response_class(
+            stream_with_context(stream_activations(rows, source)),
+            mimetype='application/json'
+        )
         
     except Exception as e:
-        logger.error(f"列出激活码失败: {e}")
+        logger.error("列出激活码失败: %s", e)
         return jsonify({"error": str(e)}), 500
 
+def iter_db_activations(limit):
+    """读取最近的激活记录；结果集很小，一次取回后立即归还连接再逐行输出"""
+    with db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute('''
+            SELECT email, activation_code, product_type, generated_at 
+            FROM activations 
+            ORDER BY generated_at DESC 
+            LIMIT %s
+            ''', (limit,))
+            rows = cursor.fetchall()
+    yield from rows
+
+def stream_activations(rows, source):
+    """逐行输出激活码列表 JSON，不在内存中拼出完整响应"""
+    yield b'{"success":true,"source":"' + source.encode() + b'","activations":['
+    count = 0
+    for row in rows:
+        if count:
+            yield b','
+        yield orjson.dumps(row, default=DefaultJSONProvider.default,
+                           option=OrjsonProvider.option)
+        count += 1
+    yield b'],"count":' + str(count).encode() + b'}'
+
+@app.route('/api/admin/cache-stats', methods=['GET'])
+@require_api_key
+def cache_stats():
+    """进程内缓存命中情况"""
+    caches = {
+        "parse_activation_code": parse_activation_code,
+        "email_hash_segment": email_hash_segment
+    }
+    return jsonify({
+        name: func.cache_info()._asdict()
+        for name, func in caches.items()
+    })
+
 # ==================== 错误处理 ====================
+@app.before_request
+def reject_oversized_request():
+    """声明的请求体超过上限时在读取前直接拒绝（路由内的通用异常处理不会把它变成 500）"""
+    if request.content_length is not None and request.content_length > config.MAX_CONTENT_LENGTH:
+        abort(413)
+
 @app.errorhandler(404)
 def not_found(error):
-    logger.warning(f"404 错误: {request.path}")
+    logger.warning("404 错误: %s", request.path)
     return jsonify({"error": "未找到请求的资源"}), 404
 
 @app.errorhandler(405)
 def method_not_allowed(error):
     return jsonify({"error": "方法不允许"}), 405
 
+@app.errorhandler(413)
+def request_too_large(error):
+    logger.warning("413 请求过大: %s", request.path)
+    return jsonify({"error": "请求过大"}), 413
+
 @app.errorhandler(500)
 def internal_error(error):
-    logger.error(f"服务器内部错误: {error}")
+    logger.error("服务器内部错误: %s", error)
     return jsonify({"error": "服务器内部错误"}), 500
 
 # ==================== 启动应用 ====================
@@ -1262,22 +1903,17 @@ if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     
     logger.info("=" * 60)
-    logger.info(f"🚀 启动 PDF Fusion Pro 激活服务器")
-    logger.info(f"📅 时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    logger.info(f"🔑 管理员密钥: {config.ADMIN_API_KEY[:8]}...")
-    logger.info(f"🔐 加密组件: {'已启用' if cipher else '未启用'}")
-    logger.info(f"📧 邮件服务: {'已配置' if smtp_configured else '未配置'}")
-    logger.info(f"💾 存储方式: {'数据库' if database_initialized else '文件'}")
-    logger.info(f"🌐 服务端口: {port}")
-    logger.info(f"🔗 Webhook地址: http://0.0.0.0:{port}/api/webhook/gumroad")
-    logger.info(f"🌍 公网地址: https://pdf-email-1.onrender.com/api/webhook/gumroad")
+    logger.info("🚀 启动 PDF Fusion Pro 激活服务器")
+    logger.info("📅 时间: %s", datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    logger.info("🔑 管理员密钥: %.8s...", config.ADMIN_API_KEY)
+    logger.info("🔐 加密组件: %s", '已启用' if cipher else '未启用')
+    logger.info("📧 邮件服务: %s", '已配置' if smtp_configured else '未配置')
+    logger.info("💾 存储方式: %s", '数据库' if config.DATABASE_URL and psycopg2 is not None else '文件')
+    logger.info("🌐 服务端口: %s", port)
+    logger.info("🔗 Webhook地址: http://0.0.0.0:%s/api/webhook/gumroad", port)
+    logger.info("🌍 公网地址: https://pdf-email-1.onrender.com/api/webhook/gumroad")
     logger.info("=" * 60)
     
-    # 启动心跳线程
-    heartbeat_thread = threading.Thread(target=keep_service_awake, daemon=True)
-    heartbeat_thread.start()
-    logger.info("💓 心跳保持线程已启动")
-    
     # 运行应用
     app.run(host='0.0.0.0', port=port, debug=False)
 
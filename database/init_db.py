@@ -46,21 +46,34 @@ def init_database(database_url=None):
         
         # 检查 schema.sql 文件
         sql_file = os.path.join(os.path.dirname(__file__), 'schema.sql')
+        # schema.sql 整体执行成功时已包含全部索引，无需再单独创建
+        schema_applied = False
         
         if os.path.exists(sql_file):
             print(f"📄 使用 SQL 文件: {sql_file}")
             with open(sql_file, 'r', encoding='utf-8') as f:
                 sql_content = f.read()
             
-            # 分割 SQL 语句
-            sql_statements = [stmt.strip() for stmt in sql_content.split(';') if stmt.strip()]
-            
-            for i, statement in enumerate(sql_statements, 1):
-                if statement:
+            try:
+                # 多条语句一次发送（简单查询协议），只需一次往返
+                cursor.execute(sql_content)
+                schema_applied = True
+                print("   ✅ 执行 SQL 文件")
+            except Exception as e:
+                print(f"   ⚠️  批量执行失败，逐条执行: {e}")
+                conn.rollback()
+                
+                # 分割 SQL 语句
+                sql_statements = [stmt.strip() for stmt in sql_content.split(';') if stmt.strip()]
+                
+                for i, statement in enumerate(sql_statements, 1):
+                    # 每条语句一个保存点，失败时不影响事务中的其他语句
+                    cursor.execute("SAVEPOINT schema_statement")
                     try:
                         cursor.execute(statement)
                         print(f"   ✅ 执行 SQL 语句 {i}/{len(sql_statements)}")
                     except Exception as e:
+                        cursor.execute("ROLLBACK TO SAVEPOINT schema_statement")
                         print(f"   ⚠️  语句 {i} 执行失败: {e}")
                         # 继续执行其他语句
         else:
@@ -129,20 +142,25 @@ def init_database(database_url=None):
                 except Exception as e:
                     print(f"   ⚠️  创建表 {i} 失败: {e}")
         
-        # 创建索引
-        indexes = [
-            "CREATE INDEX IF NOT EXISTS idx_activations_code ON activations(activation_code)",
-            "CREATE INDEX IF NOT EXISTS idx_activations_email ON activations(email)",
-            "CREATE INDEX IF NOT EXISTS idx_purchases_purchase_id ON purchases(purchase_id)",
-            "CREATE INDEX IF NOT EXISTS idx_device_activations ON device_activations(activation_id, device_id)"
-        ]
+        # 创建索引（schema.sql 已整体执行时跳过）
+        if not schema_applied:
+            indexes = [
+                "CREATE INDEX IF NOT EXISTS idx_activations_code ON activations(activation_code)",
+                "CREATE INDEX IF NOT EXISTS idx_activations_email ON activations(email)",
+                "CREATE INDEX IF NOT EXISTS idx_activations_generated_at ON activations(generated_at)",
+                "CREATE INDEX IF NOT EXISTS idx_activations_meta_purchase_id ON activations((metadata->>'purchase_id'))",
+                "CREATE INDEX IF NOT EXISTS idx_activations_meta_sale_id ON activations((metadata->>'sale_id'))",
+                "CREATE INDEX IF NOT EXISTS idx_purchases_purchase_id ON purchases(purchase_id)",
+                "CREATE INDEX IF NOT EXISTS idx_purchases_processed_at ON purchases(processed_at)",
+                "CREATE INDEX IF NOT EXISTS idx_device_activations ON device_activations(activation_id, device_id)"
+            ]
         
-        for i, index_sql in enumerate(indexes, 1):
-            try:
-                cursor.execute(index_sql)
-                print(f"   📊 创建索引 {i}/{len(indexes)}")
-            except Exception as e:
-                print(f"   ⚠️  创建索引 {i} 失败: {e}")
+            for i, index_sql in enumerate(indexes, 1):
+                try:
+                    cursor.execute(index_sql)
+                    print(f"   📊 创建索引 {i}/{len(indexes)}")
+                except Exception as e:
+                    print(f"   ⚠️  创建索引 {i} 失败: {e}")
         
         # 提交事务
         conn.commit()
@@ -50,5 +50,9 @@ CREATE TABLE IF NOT EXISTS purchases (
 -- 创建索引
 CREATE INDEX IF NOT EXISTS idx_activations_code ON activations(activation_code);
 CREATE INDEX IF NOT EXISTS idx_activations_email ON activations(email);
+CREATE INDEX IF NOT EXISTS idx_activations_generated_at ON activations(generated_at);
+CREATE INDEX IF NOT EXISTS idx_activations_meta_purchase_id ON activations((metadata->>'purchase_id'));
+CREATE INDEX IF NOT EXISTS idx_activations_meta_sale_id ON activations((metadata->>'sale_id'));
 CREATE INDEX IF NOT EXISTS idx_purchases_purchase_id ON purchases(purchase_id);
+CREATE INDEX IF NOT EXISTS idx_purchases_processed_at ON purchases(processed_at);
 CREATE INDEX IF NOT EXISTS idx_device_activations ON device_activations(activation_id, device_id);
\ No newline at end of file
@@ -0,0 +1,81 @@
+"""激活码格式测试"""
+import os
+import sys
+import tempfile
+import unittest
+from datetime import date
+
+os.environ.setdefault('ENCRYPTION_KEY', 'test-encryption-key')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 服务器在当前目录写激活记录文件，测试时切换到临时目录
+os.chdir(tempfile.mkdtemp())
+
+import activation_server  # noqa: E402
+
+
+class ProfessionalCodeTest(unittest.TestCase):
+
+    def generate(self, product_type='business'):
+        code, _ = activation_server.generate_professional_activation_code(
+            'user@example.com', product_type, 'sale-1'
+        )
+        return code
+
+    def test_code_uses_hex_groups(self):
+        for _ in range(200):
+            groups = self.generate().split('-')
+            self.assertEqual(len(groups), activation_server.CODE_GROUP_COUNT)
+            for group in groups:
+                self.assertEqual(len(group), activation_server.CODE_GROUP_SIZE)
+                int(group, 16)
+
+    def test_stripped_code_round_trips(self):
+        for product_type in activation_server.TYPE_CODES:
+            code = self.generate(product_type)
+            for variant in (code, code.replace('-', ''), code.lower()):
+                parsed = activation_server.parse_activation_code(variant)
+                self.assertIsNotNone(parsed, variant)
+                self.assertEqual(parsed[0], product_type)
+
+    def test_tampered_code_is_rejected(self):
+        code = self.generate()
+        tampered = ('0' if code[0] != '0' else '1') + code[1:]
+        self.assertIsNone(activation_server.parse_activation_code(tampered))
+
+
+class LegacyCodeTest(unittest.TestCase):
+
+    code = 'Z0FBQUFB-aE1wQ2Rm-X1Rlc3Rf-TGVnYWN5-Q29kZV8x-MjM0NTY3'
+
+    def setUp(self):
+        with open(activation_server.ACTIVATIONS_FILE, 'w', newline='', encoding='utf-8') as f:
+            f.write(','.join(activation_server.ACTIVATIONS_CSV_HEADER) + '\n')
+            f.write('2024-01-01 00:00:00,user@example.com,%s,business,2099-01-01,10\n' % self.code)
+        activation_server.parse_activation_code.cache_clear()
+
+    def test_recorded_code_uses_stored_record(self):
+        parsed = activation_server.parse_activation_code(self.code)
+        self.assertEqual(parsed[0], 'business')
+        self.assertEqual(parsed[3], date(2099, 1, 1))
+
+    def test_unknown_code_is_rejected(self):
+        forged = self.code[:-8] + 'AAAAAAAA'
+        self.assertIsNone(activation_server.parse_activation_code(forged))
+
+
+class VerifyResponseTest(unittest.TestCase):
+
+    def test_valid_until_is_a_date_for_every_code_kind(self):
+        client = activation_server.app.test_client()
+        simple_code, _ = activation_server.generate_simple_activation_code('user@example.com', 'business')
+        professional_code, _ = activation_server.generate_professional_activation_code(
+            'user@example.com', 'business', 'sale-1'
+        )
+        for code in (simple_code, professional_code):
+            response = client.post('/api/verify', json={'activation_code': code})
+            valid_until = response.get_json()['data']['valid_until']
+            self.assertEqual(valid_until, date.fromisoformat(valid_until).isoformat())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,87 +2,122 @@
 激活码生成器
 """
 
-import base64
 import json
 import hashlib
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Dict, Any, Tuple
 from cryptography.fernet import Fernet
 
+# SIMD 加速的 base64（未安装时使用标准库，接口一致）
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+# 2.1 起校验码改用 BLAKE2b；2.0 版本的激活码仍按 MD5 校验
+CHECKSUM_VERSION = "2.1"
+LEGACY_MD5_VERSION = "2.0"
+
+def compute_checksum(email: str, product_type: str, days_valid: int, version: str = CHECKSUM_VERSION) -> str:
+    """计算 8 位十六进制校验码"""
+    data = f"{email}:{product_type}:{days_valid}".encode()
+    if version == LEGACY_MD5_VERSION:
+        return hashlib.md5(data).hexdigest()[:8]
+    return hashlib.blake2b(data, digest_size=4).hexdigest()
+
+# 紧凑 JSON 编码器（只构造一次）
+_encode_json = json.JSONEncoder(separators=(',', ':')).encode
+
+# 激活码按 8 位一组、以 - 分隔；必须保留完整密文，截断后无法解密
+FORMAT_GROUP_SIZE = 8
+
 class ActivationGenerator:
     """激活码生成器"""
     
-    def __init__(self, cipher: Fernet):
+    def __init__(self, cipher: Fernet, cache_size: int = 4096):
         self.cipher = cipher
+        # 解密结果按激活码缓存（每个实例一份），重复验证不再做 Fernet 解密和 JSON 解析
+        self._decode_cached = lru_cache(maxsize=cache_size)(self._decode_payload)
     
     def generate(self, email: str, product_type: str = "personal", 
                 days_valid: int = 365, max_devices: int = 3,
                 purchase_id: str = "", note: str = "") -> Tuple[str, Dict[str, Any]]:
         """生成激活码"""
         
-        # 激活数据
+        # 激活数据（生成时间与有效期基于同一时刻）
+        now = datetime.now()
         activation_data = {
             "email": email,
             "product_type": product_type,
             "days_valid": days_valid,
-            "generated_at": datetime.now().isoformat(),
-            "valid_until": (datetime.now() + timedelta(days=days_valid)).isoformat(),
+            "generated_at": now.isoformat(),
+            "valid_until": (now + timedelta(days=days_valid)).isoformat(),
             "max_devices": max_devices,
             "purchase_id": purchase_id,
             "note": note,
-            "version": "2.0"
+            "version": CHECKSUM_VERSION
         }
         
         # 生成校验码
-        checksum = hashlib.md5(
-            f"{email}:{product_type}:{days_valid}".encode()
-        ).hexdigest()[:8]
-        activation_data['checksum'] = checksum
+        activation_data['checksum'] = compute_checksum(email, product_type, days_valid)
         
         # 加密
-        data_str = json.dumps(activation_data, separators=(',', ':'))
-        encrypted = self.cipher.encrypt(data_str.encode())
+        encrypted = self.cipher.encrypt(_encode_json(activation_data).encode())
         
-        # Base64编码
-        activation_code = base64.urlsafe_b64encode(encrypted).decode()
+        # Base64编码（Fernet 令牌只含 ASCII 字符，再编码一次后不会出现 -；末尾的 = 验证时补回）
+        activation_code = base64.urlsafe_b64encode(encrypted).decode().rstrip('=')
         
         # 格式化为易读格式
-        formatted_code = '-'.join([
-            activation_code[i:i+8] 
-            for i in range(0, len(activation_code), 8)
-        ])[:59]  # 限制长度
+        formatted_code = '-'.join(
+            activation_code[i:i + FORMAT_GROUP_SIZE]
+            for i in range(0, len(activation_code), FORMAT_GROUP_SIZE)
+        )
         
         return formatted_code, activation_data
     
+    def _decode_payload(self, code_clean: str) -> Tuple[Dict[str, Any], datetime, bool]:
+        """解密激活码，返回 (激活数据, 到期时间, 校验码是否正确)；与当前时间无关，可缓存"""
+        # Base64解码
+        encrypted = base64.urlsafe_b64decode(code_clean + '=' * (-len(code_clean) % 4))
+        
+        # 解密
+        decrypted = self.cipher.decrypt(encrypted).decode()
+        activation_data = json.loads(decrypted)
+        
+        # 验证校验码（按激活码中的版本选择算法，兼容已发放的 2.0 激活码）
+        expected_checksum = compute_checksum(
+            activation_data['email'],
+            activation_data['product_type'],
+            activation_data['days_valid'],
+            activation_data.get('version', LEGACY_MD5_VERSION)
+        )
+        
+        valid_until = datetime.fromisoformat(activation_data['valid_until'])
+        return activation_data, valid_until, activation_data.get('checksum') == expected_checksum
+    
+    def clear_cache(self):
+        """清空解密缓存（吊销激活码后调用）"""
+        self._decode_cached.cache_clear()
+    
     def verify(self, activation_code: str) -> Tuple[bool, str, Dict[str, Any]]:
         """验证激活码"""
         try:
             # 清理格式
             code_clean = activation_code.replace('-', '').replace(' ', '')
             
-            # Base64解码
-            encrypted = base64.urlsafe_b64decode(code_clean + '=' * (4 - len(code_clean) % 4))
-            
-            # 解密
-            decrypted = self.cipher.decrypt(encrypted).decode()
-            activation_data = json.loads(decrypted)
-            
-            # 验证校验码
-            expected_checksum = hashlib.md5(
-                f"{activation_data['email']}:{activation_data['product_type']}:{activation_data['days_valid']}".encode()
-            ).hexdigest()[:8]
-            
-            if activation_data.get('checksum') != expected_checksum:
+            activation_data, valid_until, checksum_ok = self._decode_cached(code_clean)
+            if not checksum_ok:
                 return False, "激活码校验失败", {}
             
-            # 检查有效期
-            valid_until = datetime.fromisoformat(activation_data['valid_until'])
-            if datetime.now() > valid_until:
+            # 检查有效期（随时间变化，不缓存）
+            now = datetime.now()
+            if now > valid_until:
                 return False, "激活码已过期", {}
             
-            # 计算剩余天数
-            days_remaining = (valid_until - datetime.now()).days
-            activation_data['days_remaining'] = days_remaining
+            # 计算剩余天数（复制一份，避免修改缓存中的数据）
+            activation_data = dict(activation_data)
+            activation_data['days_remaining'] = (valid_until - now).days
             
             return True, "激活码有效", activation_data
             
@@ -93,8 +128,6 @@ class ActivationGenerator:
         """解码激活码（不验证）"""
         try:
             code_clean = activation_code.replace('-', '').replace(' ', '')
-            encrypted = base64.urlsafe_b64decode(code_clean + '=' * (4 - len(code_clean) % 4))
-            decrypted = self.cipher.decrypt(encrypted).decode()
-            return json.loads(decrypted)
+            return dict(self._decode_cached(code_clean)[0])
         except:
-            return {}.
+            return {}
@@ -2,24 +2,74 @@
 邮件发送工具
 """
 
+import os
 import smtplib
 import logging
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from typing import Optional
+from typing import Callable, Optional
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+from .smtp_pool import SMTP_WIRE_POLICY, SMTPConnectionPool
 
 logger = logging.getLogger(__name__)
 
+# 邮件主题：已知的产品类型预先生成，其他类型按格式现拼
+_SUBJECT_FORMAT = "🎉 您的 PDF Fusion Pro {} 版激活码"
+_SUBJECTS = {
+    product_type: _SUBJECT_FORMAT.format(product_type.capitalize())
+    for product_type in ('personal', 'professional', 'business', 'enterprise')
+}
+
+# 激活邮件 HTML 模板（与服务器的邮件模板同在 templates/ 下，自动转义；启动时编译一次）
+_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
+_template_env = Environment(
+    loader=FileSystemLoader(_TEMPLATE_DIR),
+    autoescape=select_autoescape(['html'])
+)
+_EMAIL_TEMPLATE = _template_env.get_template('activation_email_zh.html')
+
 class EmailSender:
     """邮件发送器"""
     
+    __slots__ = ('host', 'port', 'username', 'password', 'from_email', 'timeout', '_pool')
+    
     def __init__(self, host: str, port: int, username: str, password: str, 
-                 from_email: Optional[str] = None):
+                 from_email: Optional[str] = None, pool_size: int = 2,
+                 max_age: float = 600, max_messages: int = 5000, timeout: float = 30):
         self.host = host
         self.port = port
         self.username = username
         self.password = password
         self.from_email = from_email or username
+        self.timeout = timeout
+        # 已登录的空闲连接，避免每封邮件重复 STARTTLS + 登录
+        self._pool = SMTPConnectionPool(host, port, username, password, size=pool_size,
+                                        max_age=max_age, max_messages=max_messages,
+                                        timeout=timeout)
+    
+    def _send(self, to_email: str, build_message: Callable[[], MIMEMultipart]):
+        """经由连接池发送；复用的连接在 NOOP 之后被断开时换新连接重试一次
+        
+        先取得可用连接再生成邮件，连接失败时不渲染模板。
+        """
+        raw_message = None
+        for attempt in range(2):
+            try:
+                with self._pool.acquire() as server:
+                    if raw_message is None:
+                        # 只序列化一次，重试时直接复用同一份字节
+                        raw_message = build_message().as_bytes(policy=SMTP_WIRE_POLICY)
+                    server.sendmail(self.from_email, [to_email], raw_message)
+                return
+            except smtplib.SMTPServerDisconnected:
+                if attempt:
+                    raise
+    
+    def close(self):
+        """关闭所有空闲连接"""
+        self._pool.close_all()
     
     def send_activation_email(self, to_email: str, activation_code: str, 
                             activation_data: dict) -> bool:
@@ -27,39 +77,40 @@ class EmailSender:
         
         # 如果没有配置邮件，记录到日志
         if not self.username or not self.password:
-            logger.info(f"[模拟发送] 激活邮件到 {to_email}")
-            logger.info(f"   激活码: {activation_code}")
-            logger.info(f"   有效期: {activation_data.get('valid_until', 'N/A')}")
+            logger.info("[模拟发送] 激活邮件到 %s", to_email)
+            logger.info("   激活码: %s", activation_code)
+            logger.info("   有效期: %s", activation_data.get('valid_until', 'N/A'))
             return True
         
         try:
-            # 创建邮件
-            msg = MIMEMultipart('alternative')
-            
-            # 主题
-            product_type = activation_data.get('product_type', 'personal').capitalize()
-            subject = f"🎉 您的 PDF Fusion Pro {product_type} 版激活码"
-            msg['Subject'] = subject
-            msg['From'] = self.from_email
-            msg['To'] = to_email
+            self._send(to_email, lambda: self._build_message(to_email, activation_code, activation_data))
             
-            # 邮件正文
-            html_content = self._create_email_content(to_email, activation_code, activation_data)
-            msg.attach(MIMEText(html_content, 'html'))
-            
-            # 发送邮件
-            with smtplib.SMTP(self.host, self.port) as server:
-                server.starttls()
-                server.login(self.username, self.password)
-                server.send_message(msg)
-            
-            logger.info(f"✅ 激活邮件已发送到 {to_email}")
+            logger.info("✅ 激活邮件已发送到 %s", to_email)
             return True
             
         except Exception as e:
-            logger.error(f"❌ 发送邮件失败: {e}")
+            logger.error("❌ 发送邮件失败: %s", e)
             return False
     
+    def _build_message(self, to_email: str, activation_code: str, 
+                       activation_data: dict) -> MIMEMultipart:
+        """创建激活邮件"""
+        msg = MIMEMultipart('alternative')
+        
+        # 主题
+        product_type = activation_data.get('product_type', 'personal')
+        subject = _SUBJECTS.get(product_type)
+        if subject is None:
+            subject = _SUBJECT_FORMAT.format(product_type.capitalize())
+        msg['Subject'] = subject
+        msg['From'] = self.from_email
+        msg['To'] = to_email
+        
+        # 邮件正文
+        html_content = self._create_email_content(to_email, activation_code, activation_data)
+        msg.attach(MIMEText(html_content, 'html'))
+        return msg
+    
     def _create_email_content(self, email: str, activation_code: str, 
                             activation_data: dict) -> str:
         """创建邮件内容"""
@@ -68,90 +119,22 @@ class EmailSender:
         valid_until = activation_data.get('valid_until', '')[:10]
         max_devices = activation_data.get('max_devices', 3)
         
-        return f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>PDF Fusion Pro 激活码</title>
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto; padding: 20px; }}
-                .header {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px; color: white; text-align: center; border-radius: 10px 10px 0 0; }}
-                .content {{ background: white; padding: 30px; border-radius: 0 0 10px 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-                .code {{ background: #f8f9fa; border: 2px dashed #667eea; padding: 20px; text-align: center; font-family: monospace; font-size: 18px; letter-spacing: 2px; margin: 20px 0; border-radius: 5px; }}
-                .info {{ background: #e7f3ff; border-left: 4px solid #1890ff; padding: 15px; margin: 20px 0; }}
-                .warning {{ background: #fff3cd; border: 1px solid #ffeaa7; padding: 15px; border-radius: 5px; margin: 20px 0; }}
-                .footer {{ text-align: center; margin-top: 30px; padding-top: 20px; border-top: 1px solid #eee; color: #666; font-size: 12px; }}
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <h1 style="margin: 0; font-size: 28px;">🎉 感谢您购买 PDF Fusion Pro！</h1>
-                <p style="margin: 10px 0 0 0; opacity: 0.9;">您的 {product_type} 版激活信息</p>
-            </div>
-            
-            <div class="content">
-                <h2 style="color: #2c3e50; margin-top: 0;">📋 激活信息</h2>
-                
-                <table style="width: 100%; border-collapse: collapse; margin-bottom: 20px;">
-                    <tr>
-                        <td style="padding: 10px; border-bottom: 1px solid #eee; width: 100px;"><strong>邮箱</strong></td>
-                        <td style="padding: 10px; border-bottom: 1px solid #eee;">{email}</td>
-                    </tr>
-                    <tr>
-                        <td style="padding: 10px; border-bottom: 1px solid #eee;"><strong>版本</strong></td>
-                        <td style="padding: 10px; border-bottom: 1px solid #eee;">{product_type} 版</td>
-                    </tr>
-                    <tr>
-                        <td style="padding: 10px;"><strong>有效期</strong></td>
-                        <td style="padding: 10px;">{valid_until}</td>
-                    </tr>
-                </table>
-                
-                <h3 style="color: #2c3e50;">🔑 您的激活码</h3>
-                <div class="code">
-                    {activation_code}
-                </div>
-                <p style="text-align: center; color: #666;">请复制此激活码，在软件激活窗口中粘贴</p>
-                
-                <div class="info">
-                    <h4 style="margin-top: 0; color: #1890ff;">🚀 激活步骤</h4>
-                    <ol>
-                        <li>下载并安装 PDF Fusion Pro</li>
-                        <li>运行软件，点击"激活"按钮</li>
-                        <li>粘贴上面的激活码</li>
-                        <li>点击"激活"完成注册</li>
-                    </ol>
-                </div>
-                
-                <div class="warning">
-                    <h4 style="margin-top: 0; color: #856404;">⚠️ 重要提醒</h4>
-                    <ul>
-                        <li>每个激活码最多可在 <strong>{max_devices} 台设备</strong> 使用</li>
-                        <li>请妥善保管此激活码，一旦丢失无法找回</li>
-                        <li>如需更换设备，请先在原设备注销</li>
-                        <li>技术支持: support@example.com</li>
-                    </ul>
-                </div>
-                
-                <div class="footer">
-                    <p>© 2024 PDF Fusion Pro. 版权所有。</p>
-                    <p>此邮件为系统自动发送，请勿直接回复。</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        return _EMAIL_TEMPLATE.render({
+            'email': email,
+            'activation_code': activation_code,
+            'product_type': product_type,
+            'valid_until': valid_until,
+            'max_devices': max_devices
+        })
     
     def test_connection(self) -> bool:
         """测试邮件连接"""
         try:
-            with smtplib.SMTP(self.host, self.port) as server:
+            with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as server:
                 server.starttls()
                 server.login(self.username, self.password)
                 server.quit()
             return True
         except Exception as e:
-            logger.error(f"邮件连接测试失败: {e}")
-            return False.
+            logger.error("邮件连接测试失败: %s", e)
+            return False
@@ -4,73 +4,78 @@ Gumroad Webhook 处理器
 
 import json
 import logging
+import re
 import hmac
 import hashlib
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Iterable, List, Optional, Tuple
 from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+from .products import DEFAULT_PRODUCT_PARAMS, PRODUCT_PARAMS, detect_product_type
 
 logger = logging.getLogger(__name__)
 
+# HMAC-SHA256 签名长度（字节），十六进制签名为其两倍
+SIGNATURE_DIGEST_SIZE = hashlib.sha256().digest_size
+
+# Gumroad 的 created_at 形如 2024-06-01T12:34:56Z，符合时直接切片，无需解析
+_ISO_DATETIME_RE = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}')
+
+def parse_price_cents(value: Any) -> int:
+    """解析 Gumroad 价格（以分为单位），兼容 "1000.0" 这类小数字符串；无法解析时按 0 处理"""
+    try:
+        return int(Decimal(str(value or 0)).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except (InvalidOperation, ValueError):
+        return 0
+
 class GumroadWebhook:
     """Gumroad Webhook处理器"""
     
+    __slots__ = ('webhook_secret', '_hmac_proto')
+    
     def __init__(self, webhook_secret: str = ""):
         self.webhook_secret = webhook_secret
+        # 密钥固定，预先完成 HMAC 的密钥处理，每次验证只需 copy()
+        self._hmac_proto = (
+            hmac.new(webhook_secret.encode(), None, hashlib.sha256)
+            if webhook_secret else None
+        )
     
     def verify_signature(self, payload: bytes, signature: str) -> bool:
         """验证Webhook签名"""
         if not self.webhook_secret:
             return True  # 如果没有设置密钥，跳过验证
         
-        expected_signature = hmac.new(
-            self.webhook_secret.encode(),
-            payload,
-            hashlib.sha256
-        ).hexdigest()
+        # 签名是十六进制字符串；先检查长度，保证比较的总是两个等长的原始摘要
+        if not isinstance(signature, str) or len(signature) != 2 * SIGNATURE_DIGEST_SIZE:
+            return False
+        try:
+            signature_bytes = bytes.fromhex(signature)
+        except ValueError:
+            return False
         
-        return hmac.compare_digest(signature, expected_signature)
+        mac = self._hmac_proto.copy()
+        mac.update(payload)
+        return hmac.compare_digest(signature_bytes, mac.digest())
+    
+    def verify_signatures(self, items: Iterable[Tuple[bytes, str]]) -> List[bool]:
+        """批量验证 (payload, signature)，用于回放或核对历史 Webhook；共用同一个密钥原型"""
+        return [self.verify_signature(payload, signature) for payload, signature in items]
     
     def parse_product_type(self, product_name: str) -> str:
         """从产品名称解析产品类型"""
-        product_name_lower = product_name.lower()
-        
-        if 'enterprise' in product_name_lower:
-            return 'enterprise'
-        elif 'business' in product_name_lower:
-            return 'business'
-        elif 'professional' in product_name_lower:
-            return 'professional'
-        elif 'personal' in product_name_lower:
-            return 'personal'
-        else:
-            # 默认判断
-            price = product_name_lower
-            if '99' in price or 'business' in price:
-                return 'business'
-            elif '299' in price or 'enterprise' in price:
-                return 'enterprise'
-            else:
-                return 'personal'
+        # 没有类型关键字时：名称中带价格 99（包括 299）按商业版处理
+        return detect_product_type(
+            product_name, default='business' if '99' in product_name else 'personal'
+        )
     
     def get_days_valid(self, product_type: str) -> int:
         """根据产品类型获取有效期"""
-        days_map = {
-            'personal': 365,
-            'professional': 365,
-            'business': 365 * 2,
-            'enterprise': 365 * 3
-        }
-        return days_map.get(product_type, 365)
+        return PRODUCT_PARAMS.get(product_type, DEFAULT_PRODUCT_PARAMS)[0]
     
     def get_max_devices(self, product_type: str) -> int:
         """根据产品类型获取最大设备数"""
-        devices_map = {
-            'personal': 3,
-            'professional': 5,
-            'business': 10,
-            'enterprise': 99
-        }
-        return devices_map.get(product_type, 3)
+        return PRODUCT_PARAMS.get(product_type, DEFAULT_PRODUCT_PARAMS)[1]
     
     def process_webhook(self, payload: Dict[str, Any]) -> Dict[str, Any]:
         """处理Webhook数据"""
@@ -79,29 +84,37 @@ class GumroadWebhook:
             purchase_id = payload.get('id', '')
             email = payload.get('email', '')
             product_name = payload.get('product_name', '')
-            price = float(payload.get('price', 0)) / 100
+            price_cents = parse_price_cents(payload.get('price'))
             currency = payload.get('currency', 'USD')
             created_at = payload.get('created_at', '')
             
             # 解析产品信息
             product_type = self.parse_product_type(product_name)
-            days_valid = self.get_days_valid(product_type)
-            max_devices = self.get_max_devices(product_type)
+            days_valid, max_devices = PRODUCT_PARAMS.get(product_type, DEFAULT_PRODUCT_PARAMS)
             
             # 格式化日期
-            try:
-                purchase_date = datetime.fromisoformat(
-                    created_at.replace('Z', '+00:00')
-                ).strftime('%Y-%m-%d %H:%M:%S')
-            except:
+            if not isinstance(created_at, str):
                 purchase_date = created_at
+            elif _ISO_DATETIME_RE.match(created_at):
+                purchase_date = f"{created_at[:10]} {created_at[11:19]}"
+            else:
+                # fromisoformat 不识别 Z 后缀，换成 +00:00
+                if created_at.endswith('Z'):
+                    iso_value = created_at[:-1] + '+00:00'
+                else:
+                    iso_value = created_at
+                try:
+                    purchase_date = datetime.fromisoformat(iso_value).strftime('%Y-%m-%d %H:%M:%S')
+                except ValueError:
+                    purchase_date = created_at
             
             result = {
                 'purchase_id': purchase_id,
                 'email': email,
                 'product_name': product_name,
                 'product_type': product_type,
-                'price': price,
+                'price_cents': price_cents,
+                'price': price_cents / 100,  # 兼容旧字段
                 'currency': currency,
                 'purchase_date': purchase_date,
                 'days_valid': days_valid,
@@ -110,13 +123,13 @@ class GumroadWebhook:
                 'success': True
             }
             
-            logger.info(f"✅ 解析Webhook: {email} -> {product_type}")
+            logger.info("✅ 解析Webhook: %s -> %s", email, product_type)
             return result
             
         except Exception as e:
-            logger.error(f"❌ 解析Webhook失败: {e}")
+            logger.error("❌ 解析Webhook失败: %s", e)
             return {
                 'success': False,
                 'error': str(e),
                 'raw_data': payload
-            }.
+            }
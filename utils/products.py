@@ -0,0 +1,32 @@
+"""
+产品类型参数与按产品名称识别类型
+激活服务器和 GumroadWebhook 共用
+"""
+
+import re
+
+# 产品类型 -> (有效天数, 最大设备数)
+PRODUCT_PARAMS = {
+    'personal': (365, 3),
+    'professional': (365, 5),
+    'business': (365 * 2, 10),
+    'enterprise': (365 * 3, 99)
+}
+DEFAULT_PRODUCT_PARAMS = PRODUCT_PARAMS['personal']
+
+# 产品名称中的类型关键字，同时出现多个时取靠前（等级更高）的一个
+PRODUCT_TYPE_KEYWORDS = ('enterprise', 'business', 'professional', 'personal')
+# 每个关键字一个命名分组，一次扫描即可得到名称中出现的全部类型，无需再转小写
+PRODUCT_TYPE_PATTERN = re.compile(
+    '|'.join(f'(?P<{keyword}>{keyword})' for keyword in PRODUCT_TYPE_KEYWORDS),
+    re.IGNORECASE
+)
+
+def detect_product_type(product_name, default='personal'):
+    """根据产品名称判断产品类型；名称中没有类型关键字时返回 default"""
+    # JSON 请求中 product_name 可能为 null
+    matches = {m.lastgroup for m in PRODUCT_TYPE_PATTERN.finditer(product_name or '')}
+    for keyword in PRODUCT_TYPE_KEYWORDS:
+        if keyword in matches:
+            return keyword
+    return default
@@ -0,0 +1,148 @@
+"""
+SMTP 连接池
+激活服务器和 EmailSender 共用
+"""
+
+import queue
+import smtplib
+import time
+from contextlib import contextmanager
+from email.policy import compat32
+
+# sendmail() 对 bytes 原样发送，序列化时需像 send_message() 一样使用 CRLF
+# （compat32 默认换行是裸 LF）
+SMTP_WIRE_POLICY = compat32.clone(linesep='\r\n')
+
+class PipeliningSMTP(smtplib.SMTP):
+    """支持 PIPELINING (RFC 2920) 的 SMTP 客户端
+    
+    服务器声明 PIPELINING 时，MAIL FROM 和所有 RCPT TO 合并为一次写入，
+    再批量读取响应，每封邮件的往返次数从 2 + 收件人数 降为 2。
+    """
+    
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        
+        # 带扩展参数或服务器不支持时走标准流程
+        if (mail_options or rcpt_options or not isinstance(msg, bytes)
+                or not self.has_extn('pipelining')):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+        
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        
+        size_option = " size=%d" % len(msg) if self.has_extn('size') else ""
+        commands = ["mail FROM:%s%s\r\n" % (smtplib.quoteaddr(from_addr), size_option)]
+        commands.extend("rcpt TO:%s\r\n" % smtplib.quoteaddr(addr) for addr in to_addrs)
+        self.send("".join(commands))
+        
+        # MAIL FROM 的响应
+        code, resp = self.getreply()
+        if code == 421:
+            self.close()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        mail_error = (code, resp) if code != 250 else None
+        
+        # RCPT TO 的响应
+        senderrs = {}
+        for addr in to_addrs:
+            code, resp = self.getreply()
+            if code not in (250, 251):
+                senderrs[addr] = (code, resp)
+            if code == 421:
+                self.close()
+                raise smtplib.SMTPRecipientsRefused(senderrs)
+        
+        if mail_error:
+            self._rset()
+            raise smtplib.SMTPSenderRefused(mail_error[0], mail_error[1], from_addr)
+        
+        if len(senderrs) == len(to_addrs):
+            self._rset()
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+        
+        code, resp = self.data(msg)
+        if code != 250:
+            if code == 421:
+                self.close()
+            else:
+                self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        
+        return senderrs
+
+class SMTPConnectionPool:
+    """SMTP 连接池 - 复用已登录的连接，避免每封邮件重复 STARTTLS + 登录"""
+    
+    def __init__(self, host, port, user, password, size=4,
+                 max_age=100, max_messages=100, timeout=30):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.max_age = max_age              # 连接最长复用时间（秒）
+        self.max_messages = max_messages    # 单个连接最多发送的邮件数
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+    
+    def _connect(self):
+        """建立新的已登录连接"""
+        server = PipeliningSMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.starttls()  # Enable secure connection
+            server.login(self.user, self.password)
+        except Exception:
+            self._close(server)
+            raise
+        return server, time.monotonic(), 0
+    
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+    
+    def _checkout(self):
+        """取出一个可用连接，过期或失效的连接直接丢弃"""
+        while True:
+            try:
+                server, created_at, sent = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            
+            if time.monotonic() - created_at > self.max_age or sent >= self.max_messages:
+                self._close(server)
+                continue
+            
+            try:
+                if server.noop()[0] == 250:
+                    return server, created_at, sent
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._close(server)
+    
+    @contextmanager
+    def acquire(self):
+        """借用连接: with pool.acquire() as server: server.send_message(msg)"""
+        server, created_at, sent = self._checkout()
+        try:
+            yield server
+        except Exception:
+            # 发送出错时连接状态未知，不再放回池中
+            self._close(server)
+            raise
+        
+        try:
+            self._idle.put_nowait((server, created_at, sent + 1))
+        except queue.Full:
+            self._close(server)
+    
+    def close_all(self):
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                server, _, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(server)
@@ -0,0 +1,39 @@
+"""
+PDF Fusion Pro - 激活服务器 WSGI 入口
+供 gunicorn 的 gevent worker 使用:
+    gunicorn -k gevent -w 2 --worker-connections 500 -b 0.0.0.0:$PORT wsgi:app
+
+必须在导入 activation_server（以及 smtplib / psycopg2）之前打补丁，
+SMTP 和数据库等待期间才会让出协程。
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+from gevent.socket import wait_read, wait_write
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+
+def gevent_wait_callback(conn, timeout=None):
+    """psycopg2 等待回调：libpq 自己管理 socket，不受 monkey patch 影响，需手动让出"""
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"psycopg2 poll() 返回未知状态: {state}")
+
+
+if psycopg2 is not None:
+    psycopg2.extensions.set_wait_callback(gevent_wait_callback)
+
+from activation_server import app  # noqa: E402